@@ -0,0 +1,132 @@
+import numpy as np
+import retrieval
+import topk
+
+
+# Inverted-file (IVF) index for approximate maximum inner product search: the indexed
+# vectors are clustered with spherical k-means, and each query is only compared to the
+# vectors in the clusters (lists) whose centroids are most similar to it (the probes).
+# Queries are processed list by list, so that each list is scored with a single GEMM
+# against all the queries that probe it.
+
+BATCH_SIZE = 10000
+
+
+def kmeans(m, n_clusters, n_iter=10, seed=0, init=None, spherical=True):
+    """
+    K-means: return the centroids and the cluster of each row of m. If spherical, the rows are
+    assigned to the centroid with the largest dot product, and the centroids have unit length.
+    Otherwise, they are assigned to the nearest centroid, and the centroids are the cluster means.
+    """
+    n_clusters = min(n_clusters, len(m))
+    rng = np.random.RandomState(seed)
+    if init is None or len(init) != n_clusters:
+        centroids = m[rng.choice(len(m), n_clusters, replace=False)]
+    else:
+        centroids = init
+    for _ in range(n_iter):
+        assignment = _nearest_centroid(m, centroids, spherical)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        order = np.argsort(assignment, kind='stable')
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        nonempty = counts > 0
+        centroids = m[rng.choice(len(m), n_clusters)]  # Empty clusters are restarted at random
+        centroids[nonempty] = np.add.reduceat(m[order], starts[nonempty], axis=0)
+        if spherical:
+            norms = np.linalg.norm(centroids, axis=1)
+            norms[norms == 0] = 1
+            centroids /= norms[:, np.newaxis]
+        else:
+            centroids[nonempty] /= counts[nonempty, np.newaxis]
+    return centroids, _nearest_centroid(m, centroids, spherical)
+
+
+def _nearest_centroid(m, centroids, spherical=True):
+    bias = None if spherical else (centroids**2).sum(axis=1) / 2  # argmin |m-c|² = argmax m·c - |c|²/2
+    ans = np.empty(len(m), dtype=np.int64)
+    for i in range(0, len(m), BATCH_SIZE):
+        j = min(i + BATCH_SIZE, len(m))
+        sim = m[i:j].dot(centroids.T)
+        if bias is not None:
+            sim -= bias
+        ans[i:j] = sim.argmax(axis=1)
+    return ans
+
+
+class IVFIndex:
+    def __init__(self, m, n_lists, n_iter=10, seed=0, init=None):
+        """Index the rows of m in n_lists clusters (starting k-means from the centroids init, if given)"""
+        self.centroids, assignment = kmeans(m, n_lists, n_iter, seed, init)
+        self.ids = np.argsort(assignment, kind='stable')
+        self.data = m[self.ids]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=len(self.centroids)))))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, q, n_probes, k=1, penalty=None, keep_prob=1.0):
+        """
+        Return the k best scores and indices for each query in q, along with its best similarity,
+        among the vectors in the n_probes most similar lists. The scores are the similarities
+        minus penalty (given for each indexed vector) after dropout, as in the exact retrieval.
+        Missing results (if there are less than k candidates) have score -inf and index -1.
+        """
+        n = len(q)
+        n_probes = min(n_probes, len(self.centroids))
+        probes = topk.topk_indices(q.dot(self.centroids.T), n_probes)
+        queries = np.repeat(np.arange(n), n_probes)[np.argsort(probes.ravel(), kind='stable')]
+        starts = np.concatenate(([0], np.cumsum(np.bincount(probes.ravel(), minlength=len(self.centroids)))))
+        scores = np.full((n, k), -np.inf, dtype=q.dtype)
+        ind = np.full((n, k), -1, dtype=np.int64)
+        best = np.full(n, -np.inf, dtype=q.dtype)
+        for l in range(len(self.centroids)):
+            qs = queries[starts[l]:starts[l+1]]
+            a, b = self.offsets[l], self.offsets[l+1]
+            if len(qs) == 0 or a == b:
+                continue
+            sim = q[qs].dot(self.data[a:b].T)
+            best[qs] = np.maximum(best[qs], sim.max(axis=1))
+            if penalty is not None:
+                sim -= penalty[self.ids[a:b]]
+            sim = retrieval.dropout(sim, 1 - keep_prob)
+            cand_scores = np.concatenate((scores[qs], sim), axis=1)
+            cand_ind = np.concatenate((ind[qs], np.broadcast_to(self.ids[a:b], sim.shape)), axis=1)
+            top = topk.topk_indices(cand_scores, k)
+            scores[qs] = np.take_along_axis(cand_scores, top, axis=1)
+            ind[qs] = np.take_along_axis(cand_ind, top, axis=1)
+        return scores, ind, best
+
+
+def nearest_neighbors(xw, zw, src_index, trg_index, n_probes, k=0, keep_prob=1.0, forward=True, backward=True):
+    """
+    Approximate counterpart of retrieval.knn_means followed by retrieval.nearest_neighbors, where
+    src_index and trg_index index xw and zw. The CSLS penalties (if k > 0) are the means of the
+    k best similarities found in the probed lists. Return best_fwd, nn_fwd, best_bwd, nn_bwd.
+    """
+    best_fwd = nn_fwd = best_bwd = nn_bwd = None
+    knn_fwd = knn_bwd = None
+    if k > 0:
+        if backward:
+            knn_fwd = _knn_mean(trg_index, xw, n_probes, k)
+        if forward:
+            knn_bwd = _knn_mean(src_index, zw, n_probes, k)
+    if forward:
+        penalty = None if knn_bwd is None else knn_bwd/2
+        _, nn_fwd, best_fwd = trg_index.search(xw, n_probes, 1, penalty, keep_prob)
+        nn_fwd = nn_fwd[:, 0]
+    if backward:
+        penalty = None if knn_fwd is None else knn_fwd/2
+        _, nn_bwd, best_bwd = src_index.search(zw, n_probes, 1, penalty, keep_prob)
+        nn_bwd = nn_bwd[:, 0]
+    return best_fwd, nn_fwd, best_bwd, nn_bwd
+
+
+def _knn_mean(index, q, n_probes, k):
+    scores = index.search(q, n_probes, k)[0]
+    scores[np.isinf(scores)] = 0
+    return scores.sum(axis=1) / k
+
+
+def recall(index, q, n_probes, nn):
+    """Fraction of the queries in q whose approximate nearest neighbor is the exact one (nn)"""
+    return np.mean(index.search(q, n_probes)[1][:, 0] == nn)
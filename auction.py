@@ -0,0 +1,106 @@
+import concurrent.futures
+import numpy as np
+import os
+
+
+# Jacobi auction algorithm with epsilon scaling for the sparse assignment problem in the format
+# of lapmod (see lat_var.sparse_costs). In each round, every unassigned row bids for its best
+# column (by benefit minus price) the price that would make it as good as its second best plus
+# epsilon, and each column goes to its highest bidder. The bids of a round are independent, so
+# they are computed in chunks by a thread pool. Each phase solves the problem for an epsilon
+# (starting from the prices of the previous one), which is divided by eps_factor until eps_min.
+# If the problem has a perfect matching and no row is given up, the final assignment is optimal
+# within n*eps_min. Otherwise there is no such bound: the rows that cannot be assigned (e.g. if
+# their candidates are all taken by other rows) keep bidding each other up in a price war, so a
+# phase gives up on the remaining rows after max_rounds rounds, or after patience rounds without
+# assigning more rows than before. Slow price wars can also make it give up on rows of problems
+# with a perfect matching (like the completed problems of lat_var), so the result is approximate
+# unless patience is large enough.
+
+AUCTION_CHUNK_SIZE = 65536
+
+
+def solve(cc, kk, ii, eps_min=1e-6, eps_factor=5.0, max_rounds=10000, patience=50, workers=None):
+    """
+    Solve the sparse assignment problem minimizing the cost, where row i can be assigned to the
+    columns kk[ii[i]:ii[i+1]] with costs cc[ii[i]:ii[i+1]].
+    Return the total cost and the column assigned to each row (-1 for the rows that were given up).
+    """
+    n = len(ii) - 1
+    benefit = -np.asarray(cc, dtype=np.float64)
+    kk = np.asarray(kk, dtype=np.int64)
+    ii = np.asarray(ii, dtype=np.int64)
+    span = benefit.max() - benefit.min() if len(benefit) > 0 else 0.0
+    prices = np.zeros(kk.max() + 1 if len(kk) > 0 else 0)
+    x = np.full(n, -1, dtype=np.int64)
+    y = np.full(len(prices), -1, dtype=np.int64)
+    eps = max(span / 4, eps_min)
+    with concurrent.futures.ThreadPoolExecutor(workers or os.cpu_count()) as pool:
+        while True:
+            x[:] = -1
+            y[:] = -1
+            fewest, stalled = n + 1, 0
+            for _ in range(max_rounds):
+                unassigned = np.flatnonzero(x < 0)
+                if len(unassigned) < fewest:
+                    fewest, stalled = len(unassigned), 0
+                else:
+                    stalled += 1
+                if len(unassigned) == 0 or stalled > patience:
+                    break
+                chunks = [unassigned[i:i+AUCTION_CHUNK_SIZE] for i in range(0, len(unassigned), AUCTION_CHUNK_SIZE)]
+                if len(chunks) == 1:
+                    bids = [_bids(chunks[0], benefit, kk, ii, prices, eps, span)]
+                else:
+                    bids = list(pool.map(lambda rows: _bids(rows, benefit, kk, ii, prices, eps, span), chunks))
+                rows, cols, values = [np.concatenate([b[f] for b in bids]) for f in range(3)]
+                if len(rows) == 0:
+                    break
+                # Each column goes to its highest bidder, and its previous owner becomes unassigned
+                order = np.lexsort((-values, cols))
+                rows, cols, values = rows[order], cols[order], values[order]
+                first = np.ones(len(cols), dtype=bool)
+                first[1:] = cols[1:] != cols[:-1]
+                rows, cols, values = rows[first], cols[first], values[first]
+                previous = y[cols]
+                x[previous[previous >= 0]] = -1
+                x[rows] = cols
+                y[cols] = rows
+                prices[cols] = values
+            if eps <= eps_min:
+                break
+            eps = max(eps / eps_factor, eps_min)
+    assigned = np.flatnonzero(x >= 0)
+    cost = _costs(assigned, x[assigned], cc, kk, ii).sum()
+    return cost, x
+
+
+def _bids(rows, benefit, kk, ii, prices, eps, span):
+    """Return the rows that bid, the columns they bid for and their bids"""
+    starts, lengths = ii[rows], ii[rows+1] - ii[rows]
+    rows, starts, lengths = rows[lengths > 0], starts[lengths > 0], lengths[lengths > 0]
+    if len(rows) == 0:
+        return rows, rows, np.empty(0)
+    offsets = np.cumsum(lengths) - lengths
+    entries = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+    values = benefit[entries] - prices[kk[entries]]
+    best = np.maximum.reduceat(values, offsets)
+    segment = np.repeat(np.arange(len(rows)), lengths)
+    ties = np.flatnonzero(values == best[segment])
+    _, first = np.unique(segment[ties], return_index=True)
+    best_entry = ties[first]
+    values[best_entry] = -np.inf
+    second = np.maximum.reduceat(values, offsets)
+    second = np.where(np.isinf(second), best - span, second)  # A single candidate is bid for as if the rest were the worst
+    return rows, kk[entries[best_entry]], prices[kk[entries[best_entry]]] + best - second + eps
+
+
+def _costs(rows, cols, cc, kk, ii):
+    """Return the cost of assigning each row to the given column (which must be one of its candidates)"""
+    ans = np.empty(len(rows))
+    for n in np.unique(ii[rows+1] - ii[rows]):
+        sel = np.flatnonzero(ii[rows+1] - ii[rows] == n)
+        entries = ii[rows[sel], np.newaxis] + np.arange(n)
+        pos = (kk[entries] == cols[sel, np.newaxis]).argmax(axis=1)
+        ans[sel] = np.asarray(cc)[entries[np.arange(len(sel)), pos]]
+    return ans
@@ -0,0 +1,299 @@
+from cupy_utils import *
+
+import argparse
+import lat_var
+import numpy as np
+import pq
+import retrieval
+import sys
+import time
+import topk
+
+
+def reference_topk_mean(m, k, inplace=False):
+    """The original implementation with k argmax sweeps, kept as a baseline"""
+    xp = get_array_module(m)
+    n = m.shape[0]
+    ans = xp.zeros(n, dtype=m.dtype)
+    if k <= 0:
+        return ans
+    if not inplace:
+        m = xp.array(m)
+    ind0 = xp.arange(n)
+    ind1 = xp.empty(n, dtype=int)
+    minimum = m.min()
+    for i in range(k):
+        m.argmax(axis=1, out=ind1)
+        ans += m[ind0, ind1]
+        m[ind0, ind1] = minimum
+    return ans / k
+
+
+def reference_csls(xw, zw, k, batch_size):
+    """The original union dictionary induction with CSLS, computing each similarity matrix twice"""
+    xp = get_array_module(xw)
+    knn_sim_fwd = xp.zeros(xw.shape[0], dtype=xw.dtype)
+    knn_sim_bwd = xp.zeros(zw.shape[0], dtype=xw.dtype)
+    trg_indices_forward = xp.zeros(xw.shape[0], dtype=int)
+    src_indices_backward = xp.zeros(zw.shape[0], dtype=int)
+    for i in range(0, zw.shape[0], batch_size):
+        j = min(i + batch_size, zw.shape[0])
+        knn_sim_bwd[i:j] = topk.topk_mean(zw[i:j].dot(xw.T), k, inplace=True)
+    for i in range(0, xw.shape[0], batch_size):
+        j = min(i + batch_size, xw.shape[0])
+        (xw[i:j].dot(zw.T) - knn_sim_bwd/2).argmax(axis=1, out=trg_indices_forward[i:j])
+    for i in range(0, xw.shape[0], batch_size):
+        j = min(i + batch_size, xw.shape[0])
+        knn_sim_fwd[i:j] = topk.topk_mean(xw[i:j].dot(zw.T), k, inplace=True)
+    for i in range(0, zw.shape[0], batch_size):
+        j = min(i + batch_size, zw.shape[0])
+        (zw[i:j].dot(xw.T) - knn_sim_fwd/2).argmax(axis=1, out=src_indices_backward[i:j])
+    return trg_indices_forward, src_indices_backward
+
+
+def csls(xw, zw, k, batch_size, memory=None):
+    knn_sim_fwd, knn_sim_bwd = retrieval.knn_means(xw, zw, k, batch_size, memory=memory)
+    _, trg_indices_forward, _, src_indices_backward = retrieval.nearest_neighbors(xw, zw, batch_size, knn_sim_fwd, knn_sim_bwd, memory=memory)
+    return trg_indices_forward, src_indices_backward
+
+
+def reference_sparse_costs(xp, sims, n_similar, n_repeats, batch_size, asym):
+    """The original construction of the lapmod input in lat_var, with Python loops"""
+    src_size = sims.shape[0]
+    cc = np.empty(src_size * n_similar)
+    kk = np.empty(src_size * n_similar)
+    ii = np.empty((src_size * n_repeats + 1,), dtype=int)
+    ii[0] = 0
+    for i in range(1, src_size * n_repeats + 1):
+        ii[i] = ii[i - 1] + n_similar
+    for i in range(0, src_size, batch_size):
+        j = min(i + batch_size, src_size)
+        sim = sims[i:j]
+        trg_indices = xp.argpartition(sim, -n_similar)[:, -n_similar:]
+        trg_indices = asnumpy(trg_indices)
+        trg_indices.sort()
+        trg_indices = trg_indices.flatten()
+        row_indices = np.array([[i] * n_similar for i in range(j-i)]).flatten()
+        cc[i * n_similar:j * n_similar] = asnumpy(1 - sim[row_indices, trg_indices])
+        kk[i * n_similar:j * n_similar] = trg_indices
+    if n_repeats > 1:
+        new_cc = cc
+        new_kk = kk
+        for i in range(1, n_repeats):
+            new_cc = np.concatenate([new_cc, cc], axis=0)
+            if asym == '1:2':
+                new_kk = np.concatenate([new_kk, kk], axis=0)
+            else:
+                new_kk = np.concatenate([new_kk, kk + src_size * i], axis=0)
+        cc = new_cc
+        kk = new_kk
+    return cc, kk, ii
+
+
+def reference_assignment_pairs(trg_indices, kk, ii, n_similar, src_size, n_repeats):
+    """The original post-processing of the lapmod assignment in lat_var, with Python loops"""
+    src_indices = np.concatenate([np.arange(src_size)] * n_repeats, 0)
+    wrong_inds = []
+    for i, trgind in enumerate(trg_indices):
+        krow = ii[i]
+        candidates = kk[krow:krow + n_similar]
+        if trgind not in candidates:
+            wrong_inds.append(i)
+    trg_indices = np.delete(trg_indices, wrong_inds)
+    src_indices = np.delete(src_indices, wrong_inds)
+    for i in range(len(src_indices)):
+        src_idx, trg_idx = src_indices[i], trg_indices[i]
+        while trg_idx >= src_size:
+            trg_idx -= src_size
+            trg_indices[i] = trg_idx
+    return src_indices, trg_indices
+
+
+def random_embeddings(xp, rng, n, dim, dtype):
+    m = rng.standard_normal((n, dim)).astype(dtype)
+    m /= np.linalg.norm(m, axis=1)[:, np.newaxis]
+    return xp.asarray(m)
+
+
+def timeit(xp, f, repeats, setup=None):
+    """Return the best wall-clock time of f over several runs, along with its last result"""
+    best = float('inf')
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        t = time.perf_counter()
+        ans = f()
+        if xp is not np:
+            xp.cuda.Stream.null.synchronize()
+        best = min(best, time.perf_counter() - t)
+    return best, ans
+
+
+def benchmark_topk(xp, dtype, args):
+    rng = np.random.RandomState(args.seed)
+    for rows in args.batch_size:
+        for cols in args.vocabulary_cutoff:
+            m = xp.asarray(rng.uniform(-1, 1, (rows, cols)).astype(dtype))
+            buf = xp.empty_like(m)
+
+            def setup():
+                buf[...] = m
+            old, ans = timeit(xp, lambda: reference_topk_mean(buf, args.k, inplace=True), args.repeats, setup)
+            new, res = timeit(xp, lambda: topk.topk_mean(buf, args.k, inplace=True), args.repeats, setup)
+            print('{0}x{1} k={2}  argmax loop: {3:.4f}s  partition: {4:.4f}s  speedup: {5:.2f}x  max. diff: {6:.2e}'.format(
+                rows, cols, args.k, old, new, old / new, float(xp.abs(ans - res).max())))
+            sys.stdout.flush()
+            del m, buf
+
+
+def benchmark_csls(xp, dtype, args):
+    rng = np.random.RandomState(args.seed)
+    for size in args.vocabulary_cutoff:
+        xw = random_embeddings(xp, rng, size, args.dim, dtype)
+        zw = random_embeddings(xp, rng, size, args.dim, dtype)
+        old, ans = timeit(xp, lambda: reference_csls(xw, zw, args.k, args.batch_size), args.repeats)
+        memory = None if args.tile_memory is None else int(args.tile_memory * 1024**2)
+        new, res = timeit(xp, lambda: csls(xw, zw, args.k, args.batch_size, memory), args.repeats)
+        agreement = (float(xp.mean(ans[0] == res[0])) + float(xp.mean(ans[1] == res[1]))) / 2
+        print('{0}x{0} dim={1} k={2} tiles={3}  4 passes: {4:.4f}s  2 passes: {5:.4f}s  speedup: {6:.2f}x  agreement: {7:.2%}'.format(
+            size, args.dim, args.k, retrieval.tile_shape(size, size, xw.dtype.itemsize, args.batch_size, memory),
+            old, new, old / new, agreement))
+        sys.stdout.flush()
+
+
+def benchmark_lat_var(xp, dtype, args):
+    rng = np.random.RandomState(args.seed)
+    for size in args.vocabulary_cutoff:
+        sims = xp.asarray(rng.uniform(-1, 1, (size, args.columns)).astype(dtype))
+        for repeats in args.n_repeats:
+            old, ans = timeit(xp, lambda: reference_sparse_costs(xp, sims, args.n_similar, repeats, args.batch_size, '1:1'), args.repeats)
+            new, res = timeit(xp, lambda: lat_var.sparse_costs(
+                *lat_var.sparse_candidates(xp, sims, args.n_similar, args.batch_size), repeats, '1:1'), args.repeats)
+            same = all(np.array_equal(a, b) for a, b in zip(ans, res))
+            print('{0}x{1} n_similar={2} n_repeats={3}  costs  loops: {4:.4f}s  vectorized: {5:.4f}s  speedup: {6:.2f}x  identical: {7}'.format(
+                size, args.columns, args.n_similar, repeats, old, new, old / new, same))
+            # A random assignment, with about 10% of the rows assigned to a target that is not among their candidates
+            cc, kk, ii = res
+            assignment = kk.reshape(-1, args.n_similar)[np.arange(len(ii) - 1), rng.randint(0, args.n_similar, len(ii) - 1)]
+            wrong = rng.rand(len(assignment)) < 0.1
+            assignment[wrong] = rng.randint(0, size * repeats, wrong.sum())
+            old, ans = timeit(np, lambda: reference_assignment_pairs(assignment.copy(), kk, ii, args.n_similar, size, repeats), args.repeats)
+            new, res = timeit(np, lambda: lat_var.assignment_pairs(assignment, kk, args.n_similar, size), args.repeats)
+            same = all(np.array_equal(a, b) for a, b in zip(ans, res))
+            print('{0}x{1} n_similar={2} n_repeats={3}  pairs  loops: {4:.4f}s  vectorized: {5:.4f}s  speedup: {6:.2f}x  identical: {7}'.format(
+                size, args.columns, args.n_similar, repeats, old, new, old / new, same))
+            sys.stdout.flush()
+        del sims
+
+
+def benchmark_auction(xp, dtype, args):
+    rng = np.random.RandomState(args.seed)
+    for size in args.vocabulary_cutoff:
+        # Matching candidates from noisy copies of random embeddings, collected without a dense similarity matrix
+        xw = random_embeddings(np, rng, size, args.dim, dtype)
+        zw = xw + args.noise * random_embeddings(np, rng, size, args.dim, dtype)
+        zw /= np.linalg.norm(zw, axis=1)[:, np.newaxis]
+        top = (np.empty((size, args.n_similar), dtype=dtype), np.empty((size, args.n_similar), dtype=int))
+        retrieval.nearest_neighbors(xw, zw, 1000, backward=False, top_fwd=top)
+        for repeats in args.n_repeats:
+            cc, kk, ii = lat_var.sparse_costs(*top, repeats, '1:1')
+            results = []
+            for solver in ('lapmod', 'auction'):
+                t, (src, trg) = timeit(np, lambda: lat_var.match(np, cc, kk, ii, args.n_similar, size, solver), args.repeats)
+                cost = (1 - np.einsum('ij,ij->i', xw[src], zw[trg])).sum()
+                results.append((t, len(src), cost))
+            print('{0} words n_similar={1} n_repeats={2}  lapmod: {3:.4f}s {4} pairs cost {5:.4f}  auction: {6:.4f}s {7} pairs cost {8:.4f}  speedup: {9:.2f}x'.format(
+                size, args.n_similar, repeats, *results[0], *results[1], results[0][0] / results[1][0]))
+            sys.stdout.flush()
+
+
+
+def benchmark_pq(xp, dtype, args):
+    rng = np.random.RandomState(args.seed)
+    for size in args.vocabulary_cutoff:
+        # Queries that are noisy copies of some of the targets, searched without CSLS
+        zw = random_embeddings(np, rng, size, args.dim, dtype)
+        qw = zw[rng.choice(size, args.queries, replace=False)] + args.noise * random_embeddings(np, rng, args.queries, args.dim, dtype)
+        qw /= np.linalg.norm(qw, axis=1)[:, np.newaxis]
+        brute, (_, ans, _, _) = timeit(np, lambda: retrieval.nearest_neighbors(qw, zw, args.batch_size, backward=False), args.repeats)
+        for subspaces in args.subspaces:
+            build, index = timeit(np, lambda: pq.PQIndex(zw, subspaces, seed=args.seed), 1)
+            new, (_, res) = timeit(np, lambda: index.search(qw, rerank=args.rerank), args.repeats)
+            print('{0} words {1} queries dim={2} subspaces={3} rerank={4}  brute force: {5:.4f}s  pq: {6:.4f}s (index {7:.4f}s)  speedup: {8:.2f}x  agreement: {9:.2%}'.format(
+                size, args.queries, args.dim, subspaces, args.rerank, brute, new, build, brute / new, float(np.mean(ans == res[:, 0]))))
+            sys.stdout.flush()
+
+
+def main():
+    # Parse command line arguments
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--repeats', type=int, default=3, help='the number of runs of each benchmark, reporting the fastest (defaults to 3)')
+    common.add_argument('--seed', type=int, default=0, help='the random seed')
+    common.add_argument('--precision', choices=['fp16', 'fp32', 'fp64'], default='fp32', help='the floating-point precision (defaults to fp32)')
+    common.add_argument('--cuda', action='store_true', help='use cuda (requires cupy)')
+    parser = argparse.ArgumentParser(description='Benchmark the performance critical parts of VecMap')
+    subparsers = parser.add_subparsers(dest='benchmark', help='the benchmark to run')
+    subparsers.required = True
+    topk_parser = subparsers.add_parser('topk', parents=[common], help='top-k mean of each row of a similarity matrix block (as in CSLS)')
+    topk_parser.add_argument('--batch_size', type=int, nargs='+', default=[1000, 10000], help='the block sizes (defaults to 1000 and 10000, as used by map_embeddings.py)')
+    topk_parser.add_argument('--vocabulary_cutoff', type=int, nargs='+', default=[20000, 40000], help='the number of columns (defaults to 20000 and 40000)')
+    topk_parser.add_argument('-k', type=int, default=10, help='the neighborhood size (defaults to 10)')
+    csls_parser = subparsers.add_parser('csls', parents=[common], help='bidirectional CSLS dictionary induction in self-learning (direction union)')
+    csls_parser.add_argument('--batch_size', type=int, default=10000, help='the batch size (defaults to 10000)')
+    csls_parser.add_argument('--vocabulary_cutoff', type=int, nargs='+', default=[20000, 40000], help='the vocabulary sizes (defaults to 20000 and 40000)')
+    csls_parser.add_argument('--tile_memory', type=float, default=None, help='the memory budget in MB for the similarity matrix tiles (defaults to batch_size full rows)')
+    csls_parser.add_argument('--dim', type=int, default=300, help='the embedding dimensionality (defaults to 300)')
+    csls_parser.add_argument('-k', type=int, default=10, help='the neighborhood size (defaults to 10)')
+    lat_var_parser = subparsers.add_parser('lat_var', parents=[common], help='construction of the sparse assignment costs in the latent-variable model and post-processing of the assignment')
+    lat_var_parser.add_argument('--batch_size', type=int, default=1000, help='the batch size (defaults to 1000)')
+    lat_var_parser.add_argument('--vocabulary_cutoff', type=int, nargs='+', default=[10000, 50000, 200000], help='the number of source words (defaults to 10000, 50000 and 200000)')
+    lat_var_parser.add_argument('--columns', type=int, default=100, help='the number of target words in the similarity matrix (defaults to 100, as it only affects the candidate selection)')
+    lat_var_parser.add_argument('--n_similar', type=int, default=3, help='the number of candidates per source word (defaults to 3)')
+    lat_var_parser.add_argument('--n_repeats', type=int, nargs='+', default=[1, 3], help='the number of repeats (defaults to 1 and 3)')
+    auction_parser = subparsers.add_parser('auction', parents=[common], help='the auction and lapmod assignment solvers for the matching in the latent-variable model')
+    auction_parser.add_argument('--vocabulary_cutoff', type=int, nargs='+', default=[10000, 40000], help='the number of words (defaults to 10000 and 40000)')
+    auction_parser.add_argument('--dim', type=int, default=50, help='the embedding dimensionality (defaults to 50)')
+    auction_parser.add_argument('--noise', type=float, default=3.0, help='the norm of the noise added to the (unit length) source embeddings to get the target ones (defaults to 3.0)')
+    auction_parser.add_argument('--n_similar', type=int, default=3, help='the number of candidates per source word (defaults to 3)')
+    auction_parser.add_argument('--n_repeats', type=int, nargs='+', default=[1, 2], help='the number of repeats (defaults to 1 and 2)')
+    pq_parser = subparsers.add_parser('pq', parents=[common], help='nearest neighbor search through a product quantizer against brute force (as in eval_translation.py --pq)')
+    pq_parser.add_argument('--batch_size', type=int, default=500, help='the batch size of brute force (defaults to 500, as used by eval_translation.py)')
+    pq_parser.add_argument('--vocabulary_cutoff', type=int, nargs='+', default=[20000, 200000], help='the number of target words (defaults to 20000 and 200000)')
+    pq_parser.add_argument('--queries', type=int, default=1500, help='the number of queries (defaults to 1500, as in the test dictionaries)')
+    pq_parser.add_argument('--dim', type=int, default=300, help='the embedding dimensionality (defaults to 300)')
+    pq_parser.add_argument('--noise', type=float, default=0.5, help='the norm of the noise added to the (unit length) target embeddings to get the queries (defaults to 0.5)')
+    pq_parser.add_argument('--subspaces', type=int, nargs='+', default=[10, 30], help='the number of subspaces (defaults to 10 and 30)')
+    pq_parser.add_argument('--rerank', type=int, default=10, help='the number of candidates re-ranked exactly (defaults to 10)')
+    args = parser.parse_args()
+
+    # Choose the right dtype for the desired precision
+    if args.precision == 'fp16':
+        dtype = 'float16'
+    elif args.precision == 'fp32':
+        dtype = 'float32'
+    elif args.precision == 'fp64':
+        dtype = 'float64'
+
+    # NumPy/CuPy management
+    if args.cuda:
+        if not supports_cupy():
+            print('ERROR: Install CuPy for CUDA support', file=sys.stderr)
+            sys.exit(-1)
+        xp = get_cupy()
+    else:
+        xp = np
+
+    if args.benchmark == 'topk':
+        benchmark_topk(xp, dtype, args)
+    elif args.benchmark == 'csls':
+        benchmark_csls(xp, dtype, args)
+    elif args.benchmark == 'lat_var':
+        benchmark_lat_var(xp, dtype, args)
+    elif args.benchmark == 'auction':
+        benchmark_auction(xp, dtype, args)
+    elif args.benchmark == 'pq':
+        benchmark_pq(xp, dtype, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,66 +15,1055 @@
 
 from cupy_utils import *
 
+import bz2
+import concurrent.futures
+import gzip
+import io
+import lzma
 import numpy as np
+import os
+import queue
+import tempfile
+import threading
 
 
-def read(file, threshold=0, vocabulary=None, dtype='float'):
-    header = file.readline().split(' ')
-    count = int(header[0]) if threshold <= 0 else min(threshold, int(header[0]))
-    dim = int(header[1])
+FORMATS = ('text', 'bin', 'fp16', 'int8', 'int8dim')
+
+
+def read(file, threshold=0, vocabulary=None, dtype='float', format='auto', cache=True, workers=None, dequantize=True):
+    words, matrix = _read(file, threshold, vocabulary, dtype, format, cache, workers, dequantize)
+    return words if isinstance(words, Vocabulary) else Vocabulary(words, _encoding(file)), matrix
+
+
+def _read(file, threshold, vocabulary, dtype, format, cache, workers, dequantize):
+    path = _path(file)
+    encoding = _encoding(file)
+    words, matrix = _read_cache(path, encoding, dtype, threshold) if cache and path is not None else (None, None)
+    if words is None:
+        compression = detect_compression(file)
+        if compression is not None:
+            file = _decompress(file, compression)
+        if format == 'auto':
+            format = detect_format(file)
+        if format in QUANTIZATIONS:
+            return _read_quantized(_binary(file), encoding, format, threshold, vocabulary, dtype, dequantize)
+        stream = path is None or compression is not None  # Cannot be split into byte ranges or seeked
+        if format == 'bin' and (path is None or not cache):
+            return _read_binary(_binary(file), encoding, threshold, vocabulary, dtype)
+        if stream and (path is None or not cache):
+            return _read_text(file, threshold, vocabulary, dtype)
+        if not cache:
+            return _read_parallel(path, encoding, threshold, vocabulary, dtype, workers)
+        if vocabulary is not None and not stream:
+            return _read_indexed(path, encoding, format, threshold, vocabulary, dtype)
+        if format == 'bin':
+            words, matrix = _read_binary(_binary(file), encoding, threshold, dtype=dtype)
+            words, matrix = _save_cache(path, encoding, words, matrix, threshold)
+        elif stream:
+            words, matrix = _read_text(file, threshold, dtype=dtype)
+            words, matrix = _save_cache(path, encoding, words, matrix, threshold)
+        else:
+            words, matrix = _read_parallel(path, encoding, threshold, dtype=dtype, workers=workers, cache=True)
+    if threshold > 0:
+        words, matrix = words[:threshold], matrix[:threshold]
+    if vocabulary is not None:
+        ind = np.flatnonzero(Vocabulary(vocabulary, encoding).lookup(words) >= 0)
+        return words[ind], np.array(matrix[ind], dtype=dtype)
+    return words, matrix
+
+
+def detect_format(file):
+    """Tell apart the word2vec text and binary formats and the quantized formats by peeking at the first entry"""
+    stream = _binary(file)
+    if not hasattr(stream, 'peek'):
+        return 'text'
+    sample = stream.peek(1 << 16)
+    header, _, line = sample.partition(b'\n')
+    fields = header.split()
+    if len(fields) == 3 and fields[2].decode('ascii', errors='replace') in QUANTIZATIONS:
+        return fields[2].decode('ascii')
+    line, newline, _ = line.partition(b'\n')
+    word, _, vec = line.partition(b' ')
+    if not vec or vec.translate(None, b'0123456789.+-eEinfaINFA \t\r'):
+        return 'bin'
+    if newline and len(vec.split()) != int(header.split()[1]):
+        return 'bin'
+    return 'text'
+
+
+# Compressed files (gzip, bz2 or xz) are recognized by their magic number when reading, and
+# by their extension when writing. The (de)compression runs in a background thread that
+# exchanges chunks with the caller through a bounded queue, so that it overlaps with the
+# parsing or formatting of the embeddings.
+
+COMPRESSIONS = {
+    'gzip': (b'\x1f\x8b', ('.gz',)),
+    'bz2': (b'BZh', ('.bz2',)),
+    'xz': (b'\xfd7zXZ\x00', ('.xz', '.lzma')),
+}
+
+
+def detect_compression(file):
+    stream = _binary(file)
+    if not hasattr(stream, 'peek'):
+        return None
+    sample = stream.peek(8)
+    for compression, (magic, extensions) in COMPRESSIONS.items():
+        if sample.startswith(magic):
+            return compression
+    return None
+
+
+def decompress(file):
+    """Return a file object that decompresses the given file if it is compressed, or the file itself otherwise"""
+    compression = detect_compression(file)
+    return file if compression is None else _decompress(file, compression)
+
+
+def _compression_from_name(file):
+    name = getattr(file, 'name', None)
+    if isinstance(name, str):
+        for compression, (magic, extensions) in COMPRESSIONS.items():
+            if name.endswith(extensions):
+                return compression
+    return None
+
+
+def _decompress(file, compression):
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=_binary(file), mode='rb')
+    elif compression == 'bz2':
+        stream = bz2.BZ2File(_binary(file), mode='rb')
+    else:
+        stream = lzma.LZMAFile(_binary(file), mode='rb')
+    stream = io.BufferedReader(_BackgroundReader(stream, file), buffer_size=COMPRESSION_CHUNK_SIZE)
+    if not isinstance(file, io.TextIOBase):
+        return stream
+    return io.TextIOWrapper(stream, encoding=_encoding(file), errors=getattr(file, 'errors', None))
+
+
+def _compress(file, compression):
+    file.flush()
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=_binary(file), mode='wb', compresslevel=6)
+    elif compression == 'bz2':
+        stream = bz2.BZ2File(_binary(file), mode='wb')
+    else:
+        stream = lzma.LZMAFile(_binary(file), mode='wb')
+    stream = io.BufferedWriter(_BackgroundWriter(stream, file), buffer_size=COMPRESSION_CHUNK_SIZE)
+    if not isinstance(file, io.TextIOBase):
+        return stream
+    return io.TextIOWrapper(stream, encoding=_encoding(file), errors=getattr(file, 'errors', None))
+
+
+COMPRESSION_CHUNK_SIZE = 1 << 20
+COMPRESSION_QUEUE_SIZE = 16
+
+
+class _BackgroundReader(io.RawIOBase):
+    """Read a stream in a background thread, keeping the source file it wraps open"""
+
+    def __init__(self, stream, source):
+        self._source = source
+        self._queue = queue.Queue(COMPRESSION_QUEUE_SIZE)
+        self._stop = threading.Event()
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._run, args=(stream,), daemon=True)
+        self._thread.start()
+
+    def _run(self, stream):
+        try:
+            while not self._stop.is_set():
+                chunk = stream.read(COMPRESSION_CHUNK_SIZE)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self._put(e)
+        finally:
+            stream.close()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._chunk and not self._eof:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            self._eof = not item
+            self._chunk = memoryview(item)
+        n = min(len(b), len(self._chunk))
+        b[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        self._stop.set()
+        super().close()
+
+
+class _BackgroundWriter(io.RawIOBase):
+    """Write into a stream in a background thread, flushing the given target when closed"""
+
+    def __init__(self, stream, target):
+        self._queue = queue.Queue(COMPRESSION_QUEUE_SIZE)
+        self._error = None
+        self._target = target
+        self._thread = threading.Thread(target=self._run, args=(stream,), daemon=True)
+        self._thread.start()
+
+    def _run(self, stream):
+        try:
+            for chunk in iter(self._queue.get, None):
+                if self._error is None:
+                    stream.write(chunk)
+            stream.close()
+        except Exception as e:
+            self._error = e
+            for chunk in iter(self._queue.get, None):
+                pass
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(bytes(b))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self._queue.put(None)
+            self._thread.join()
+            self._target.flush()
+        super().close()
+        if self._error is not None:
+            raise self._error
+
+
+def _binary(file):
+    return getattr(file, 'buffer', file)
+
+
+def _encoding(file):
+    return getattr(file, 'encoding', None) or 'utf-8'
+
+
+class Vocabulary:
+    """
+    A sequence of words stored compactly as a single buffer of newline-terminated words and
+    an array with the offset of each of them, which replaces a list of words together with
+    a {word: i} dict. Words are looked up in bulk through a sorted array of 64-bit hashes.
+    Indexing with an int gives a str, while slices and index arrays give a new Vocabulary.
+    """
+
+    def __init__(self, words=(), encoding='utf-8'):
+        if isinstance(words, Vocabulary) and words.encoding == encoding:
+            data, offsets = words.data, words.offsets
+        else:
+            data = ''.join([word + '\n' for word in words]).encode(encoding, errors='surrogateescape')
+            data = np.frombuffer(data, dtype=np.uint8)
+            offsets = None
+        self._init(data, offsets, encoding)
+
+    @classmethod
+    def from_buffer(cls, data, encoding='utf-8'):
+        """Build a vocabulary from newline-terminated words in a bytes-like object or uint8 array"""
+        vocabulary = cls.__new__(cls)
+        vocabulary._init(np.frombuffer(data, dtype=np.uint8) if isinstance(data, bytes) else data, None, encoding)
+        return vocabulary
+
+    def _init(self, data, offsets, encoding):
+        if offsets is None:
+            offsets = np.empty(np.count_nonzero(data == 10) + 1, dtype=np.int64)
+            offsets[0] = 0
+            offsets[1:] = np.flatnonzero(data == 10) + 1
+        self.data = data
+        self.offsets = offsets
+        self.encoding = encoding
+        self._hashes = None
+        self._order = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            stop = max(start, stop)
+            data = self.data[self.offsets[start]:self.offsets[stop]]
+            return Vocabulary._from_parts(data, self.offsets[start:stop+1] - self.offsets[start], self.encoding)
+        if isinstance(i, (int, np.integer)):
+            i = int(i) + len(self) if i < 0 else int(i)
+            if not 0 <= i < len(self):
+                raise IndexError('vocabulary index out of range')
+            return self.data[self.offsets[i]:self.offsets[i+1]-1].tobytes().decode(self.encoding, errors='surrogateescape')
+        ind = np.asarray(i, dtype=np.int64).reshape(-1)
+        lengths = (self.offsets[1:] - self.offsets[:-1])[ind]
+        offsets = np.zeros(len(ind) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        pos = np.arange(offsets[-1]) + np.repeat(self.offsets[ind] - offsets[:-1], lengths)
+        return Vocabulary._from_parts(self.data[pos], offsets, self.encoding)
+
+    @classmethod
+    def _from_parts(cls, data, offsets, encoding):
+        vocabulary = cls.__new__(cls)
+        vocabulary._init(data, offsets, encoding)
+        return vocabulary
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __contains__(self, word):
+        return self.lookup([word])[0] >= 0
+
+    def __repr__(self):
+        return 'Vocabulary({0})'.format(self.tolist() if len(self) <= 10 else self[:10].tolist()[:-1] + ['...'])
+
+    def tolist(self):
+        words = self.data.tobytes().decode(self.encoding, errors='surrogateescape').split('\n')
+        return words[:-1]
+
+    def tobytes(self):
+        """Return the newline-terminated words"""
+        return self.data.tobytes()
+
+    def lookup(self, words):
+        """
+        Find the index of each of the given words (a Vocabulary or any sequence of str) at once,
+        returning an int64 array with -1 for missing words. Like a {word: i} dict built from the
+        vocabulary, repeated words map to their last occurrence.
+        """
+        if not isinstance(words, Vocabulary) or words.encoding != self.encoding:
+            words = Vocabulary(words, self.encoding)
+        if self._hashes is None:
+            hashes = _hash_words(self.data, self.offsets)
+            self._order = np.argsort(hashes, kind='stable')
+            self._hashes = hashes[self._order]
+        hashes = _hash_words(words.data, words.offsets)
+        left = np.searchsorted(self._hashes, hashes, side='left')
+        right = np.searchsorted(self._hashes, hashes, side='right')
+        ans = np.full(len(words), -1, dtype=np.int64)
+
+        # Confirm the candidates with the highest index for each hash by comparing their bytes
+        k = np.flatnonzero(right > left)
+        i = self._order[right[k] - 1]
+        lengths = words.offsets[k+1] - words.offsets[k]
+        same = lengths == self.offsets[i+1] - self.offsets[i]
+        k, i, lengths = k[same], i[same], lengths[same]
+        offsets = np.zeros(len(k) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        pos = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+        equal = words.data[np.repeat(words.offsets[k], lengths) + pos] == self.data[np.repeat(self.offsets[i], lengths) + pos]
+        if len(k) > 0:
+            equal = np.logical_and.reduceat(equal, offsets[:-1])
+            ans[k[equal]] = i[equal]
+
+        # Fall back to a linear search among the words sharing the hash in case of collisions
+        for k in np.flatnonzero((ans < 0) & (right - left > 1)):
+            query = words.data[words.offsets[k]:words.offsets[k+1]]
+            for i in self._order[left[k]:right[k]][::-1]:
+                if np.array_equal(self.data[self.offsets[i]:self.offsets[i+1]], query):
+                    ans[k] = i
+                    break
+        return ans
+
+
+HASH_BATCH_SIZE = 1 << 20
+
+
+def _hash_words(data, offsets):
+    """Polynomial hash of each newline-terminated word modulo 2**64, computed with array operations"""
+    n = len(offsets) - 1
+    hashes = np.zeros(n, dtype=np.uint64)
+    if n == 0:
+        return hashes
+    lengths = offsets[1:] - offsets[:-1]
+    powers = np.full(int(lengths.max()), 0x100000001b3, dtype=np.uint64)
+    powers[0] = 1
+    powers = np.cumprod(powers, dtype=np.uint64)
+    for i in range(0, n, HASH_BATCH_SIZE):
+        j = min(i + HASH_BATCH_SIZE, n)
+        chunk = data[offsets[i]:offsets[j]].astype(np.uint64)
+        chunk *= powers[np.arange(len(chunk)) - np.repeat(offsets[i:j] - offsets[i], lengths[i:j])]
+        hashes[i:j] = np.add.reduceat(chunk, offsets[i:j] - offsets[i])
+    return hashes
+
+
+def read_header(file, format='text'):
+    """
+    Read the header of an embedding file, returning its number of embeddings and dimensionality
+    (followed by the quantization and the per-dimension scale, if any, for the quantized formats)
+    """
+    line = file.readline() if format == 'text' else _binary(file).readline().decode('ascii')
+    header = line.split()
+    count, dim = int(header[0]), int(header[1])
+    if format not in QUANTIZATIONS:
+        return count, dim
+    quantization = header[2]
+    scale = None
+    if quantization == 'int8dim':
+        data = _binary(file).read(4*dim + 1)
+        if len(data) != 4*dim + 1:
+            raise ValueError('Malformed embeddings: truncated scale')
+        scale = np.frombuffer(data[:4*dim], dtype='<f4').astype(np.float32)
+    return count, dim, quantization, scale
+
+
+def iter_batches(file, batch_size=10000, threshold=0, vocabulary=None, dtype='float', format='auto', header=None):
+    """
+    Read an embedding file in a single pass, yielding (words, matrix) batches of at most
+    batch_size embeddings, so that it can be processed in constant memory.
+    The header can be given as returned by read_header if it has already been read, in which case the format must not be 'auto' and a compressed file must have been
+    wrapped with decompress.
+    """
+    if header is None:
+        file = decompress(file)
+    if format == 'auto':
+        format = detect_format(file)
+    header = read_header(file, format) if header is None else header
+    count, dim = header[:2]
+    count = count if threshold <= 0 else min(threshold, count)
+    if format in QUANTIZATIONS:
+        yield from _iter_binary(_binary(file), _encoding(file), count, dim, batch_size, vocabulary, dtype, *header[2:])
+    elif format == 'bin':
+        yield from _iter_binary(_binary(file), _encoding(file), count, dim, batch_size, vocabulary, dtype)
+    else:
+        yield from _iter_text(file, count, dim, batch_size, vocabulary, dtype)
+
+
+READ_BATCH_SIZE = 10000
+
+
+def _read_text(file, threshold=0, vocabulary=None, dtype='float'):
+    count, dim = read_header(file)
+    count = count if threshold <= 0 else min(threshold, count)
+    return _read_batches(_iter_text(file, count, dim, READ_BATCH_SIZE, vocabulary, dtype), count, dim, vocabulary, dtype)
+
+
+def _read_batches(batches, count, dim, vocabulary, dtype):
     words = []
-    matrix = np.empty((count, dim), dtype=dtype) if vocabulary is None else []
-    for i in range(count):
-        word, vec = file.readline().split(' ', 1)
+    matrix = np.empty((count, dim), dtype=dtype) if vocabulary is None else [np.empty((0, dim), dtype=dtype)]
+    for batch_words, batch in batches:
         if vocabulary is None:
-            words.append(word)
-            matrix[i] = np.fromstring(vec, sep=' ', dtype=dtype)
-        elif word in vocabulary:
-            words.append(word)
-            matrix.append(np.fromstring(vec, sep=' ', dtype=dtype))
-    return (words, matrix) if vocabulary is None else (words, np.array(matrix, dtype=dtype))
+            matrix[len(words):len(words)+len(batch_words)] = batch
+        else:
+            matrix.append(batch)
+        words += batch_words
+    return (words, matrix) if vocabulary is None else (words, np.concatenate(matrix))
+
+
+def _iter_text(file, count, dim, batch_size, vocabulary, dtype):
+    for i in range(0, count, batch_size):
+        words = []
+        vecs = []
+        for _ in range(min(batch_size, count - i)):
+            word, vec = file.readline().split(' ', 1)
+            if vocabulary is None or word in vocabulary:
+                words.append(word)
+                vecs.append(vec)
+        yield words, _parse_block(' '.join(vecs), len(vecs), dim, dtype)
+
+
+def _parse_block(data, n, dim, dtype):
+    matrix = np.fromstring(data, sep=' ', dtype=dtype)
+    if matrix.size != n*dim:
+        raise ValueError('Malformed embeddings: expected {0} values but found {1}'.format(n*dim, matrix.size))
+    return matrix.reshape(n, dim)
+
+
+# The word2vec binary format has the same header as the text format, followed by each
+# word, a space and its vector as little-endian float32 (optionally ending with a newline).
+# Records are located in large chunks, and each batch is decoded with a single frombuffer.
+
+BINARY_CHUNK_SIZE = 1 << 24
+
+
+def _read_binary(file, encoding='utf-8', threshold=0, vocabulary=None, dtype='float'):
+    count, dim = read_header(file, 'bin')
+    count = count if threshold <= 0 else min(threshold, count)
+    return _read_batches(_iter_binary(file, encoding, count, dim, READ_BATCH_SIZE, vocabulary, dtype), count, dim, vocabulary, dtype)
+
+
+def _iter_binary(file, encoding, count, dim, batch_size, vocabulary, dtype, quantization=None, scale=None, dequantize=True):
+    width = 4*dim if quantization is None else _quantized_width(dim, quantization)
+    row = 0
+    buf = b''
+    pos = 0
+    while row < count:
+        words = []
+        starts = []
+        while row + len(starts) < count and len(starts) < batch_size:
+            space = buf.find(b' ', pos)
+            if space < 0 or space + 1 + width > len(buf):
+                if starts:
+                    break
+                chunk = file.read(max(BINARY_CHUNK_SIZE, width + 1024))
+                if not chunk:
+                    raise ValueError('Expected {0} embeddings but found {1}'.format(count, row))
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            word = buf[pos:space].lstrip(b'\n').decode(encoding, errors='surrogateescape')
+            if vocabulary is None or word in vocabulary:
+                words.append(word)
+                starts.append(space + 1)
+            else:
+                starts.append(-1)
+            pos = space + 1 + width
+        row += len(starts)
+        starts = np.array(starts, dtype=np.int64)
+        starts = starts[starts >= 0]
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        rows = raw[starts[:, np.newaxis] + np.arange(width)]
+        if quantization is None:
+            yield words, rows.view('<f4').reshape(len(starts), dim).astype(dtype)
+        else:
+            block = _decode_quantized(rows, dim, quantization, scale)
+            yield words, block.dequantize(dtype) if dequantize else block
 
 
-def write(words, matrix, file):
+def _write_binary(words, m, file, encoding='utf-8'):
+    for i in range(0, len(words), WRITE_BATCH_SIZE):
+        rows = _encode_quantized(m[i:i+WRITE_BATCH_SIZE]) if isinstance(m, Quantized) else m[i:i+WRITE_BATCH_SIZE].astype('<f4')
+        data = rows.tobytes()
+        width = len(data) // max(len(rows), 1)
+        file.write(b''.join([word.encode(encoding, errors='surrogateescape') + b' ' + data[k*width:(k+1)*width] + b'\n'
+                             for k, word in enumerate(words[i:i+WRITE_BATCH_SIZE])]))
+
+
+# The quantized formats have a header with the number of embeddings, their dimensionality
+# and the quantization, followed by records like those of the word2vec binary format:
+#  - fp16: the vector as little-endian float16
+#  - int8: a little-endian float32 scale followed by the vector divided by it as int8
+#  - int8dim: the vector divided by a per-dimension scale as int8, the float32 scales
+#    being stored once right after the header (followed by a newline)
+
+QUANTIZATIONS = ('fp16', 'int8', 'int8dim')
+
+
+class Quantized:
+    """A quantized embedding matrix, as returned by read with dequantize=False"""
+
+    def __init__(self, codes, scale, quantization):
+        self.codes = codes
+        self.scale = scale
+        self.quantization = quantization
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        scale = self.scale[key] if self.quantization == 'int8' else self.scale
+        return Quantized(self.codes[key], scale, self.quantization)
+
+    def dequantize(self, dtype='float'):
+        matrix = self.codes.astype(dtype)
+        if self.quantization == 'int8':
+            matrix *= self.scale.astype(dtype)[:, np.newaxis]
+        elif self.quantization == 'int8dim':
+            matrix *= self.scale.astype(dtype)
+        return matrix
+
+
+def quantize(matrix, quantization):
     m = asnumpy(matrix)
-    print('%d %d' % m.shape, file=file)
-    for i in range(len(words)):
-        print(words[i] + ' ' + ' '.join(['%.6g' % x for x in m[i]]), file=file)
+    if quantization == 'fp16':
+        return Quantized(m.astype(np.float16), None, quantization)
+    axis = 1 if quantization == 'int8' else 0
+    scale = (np.abs(m).max(axis=axis, initial=0) / 127).astype(np.float32)
+    scale[scale == 0] = 1
+    codes = np.rint(m / (scale[:, np.newaxis] if axis == 1 else scale))
+    return Quantized(codes.astype(np.int8), scale, quantization)
+
+
+def _quantized_width(dim, quantization):
+    return {'fp16': 2*dim, 'int8': 4 + dim, 'int8dim': dim}[quantization]
+
+
+def _decode_quantized(rows, dim, quantization, scale):
+    if quantization == 'fp16':
+        return Quantized(rows.view('<f2').reshape(len(rows), dim), None, quantization)
+    if quantization == 'int8':
+        scale = np.ascontiguousarray(rows[:, :4]).view('<f4').reshape(len(rows)).astype(np.float32)
+        return Quantized(rows[:, 4:].view(np.int8), scale, quantization)
+    return Quantized(rows.view(np.int8), scale, quantization)
+
+
+def _encode_quantized(m):
+    codes = np.ascontiguousarray(m.codes, dtype='<f2' if m.quantization == 'fp16' else np.int8).view(np.uint8)
+    if m.quantization != 'int8':
+        return codes
+    return np.hstack([np.ascontiguousarray(m.scale, dtype='<f4').reshape(len(m), 1).view(np.uint8), codes])
+
+
+def _read_quantized(file, encoding, format, threshold, vocabulary, dtype, dequantize):
+    count, dim, quantization, scale = read_header(file, format)
+    count = count if threshold <= 0 else min(threshold, count)
+    batches = _iter_binary(file, encoding, count, dim, READ_BATCH_SIZE, vocabulary, dtype, quantization, scale, dequantize)
+    if dequantize:
+        return _read_batches(batches, count, dim, vocabulary, dtype)
+    words = []
+    codes = [np.empty((0, dim), dtype=np.float16 if quantization == 'fp16' else np.int8)]
+    scales = [np.empty(0, dtype=np.float32)]
+    for batch_words, block in batches:
+        words += batch_words
+        codes.append(block.codes)
+        scales.append(block.scale if quantization == 'int8' else scales[0])
+    return words, Quantized(np.concatenate(codes), np.concatenate(scales) if quantization == 'int8' else scale, quantization)
+
+
+# Parallel parser: the file is split into byte ranges on line boundaries, and each range
+# is parsed with a single np.fromstring call in a worker process. Unless a vocabulary is
+# given, the workers write their rows straight into a shared .npy file, which is either
+# moved into the cache below or loaded into memory.
+
+PARALLEL_MIN_BYTES = 1 << 24
+
+
+def _read_parallel(path, encoding, threshold=0, vocabulary=None, dtype='float', workers=None, cache=False):
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    with open(path, 'rb') as f:
+        header = f.readline().split()
+        count = int(header[0]) if threshold <= 0 else min(threshold, int(header[0]))
+        dim = int(header[1])
+        size = os.fstat(f.fileno()).st_size
+        n = 1 if workers <= 1 or size < PARALLEL_MIN_BYTES else 4*workers
+        bounds = [f.tell()]
+        for k in range(1, n):
+            f.seek(max(bounds[0] + (size - bounds[0])*k//n, bounds[-1]) - 1)
+            f.readline()
+            bounds.append(f.tell())
+        bounds.append(size)
+    ranges = [(path, bounds[k], bounds[k+1]) for k in range(n) if bounds[k] < bounds[k+1]]
+
+    out = None
+    if vocabulary is None and cache:
+        out = _cache_tmp(path)
+        try:
+            np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=(count, dim)).flush()
+        except OSError:  # The cache is only an optimization (e.g. the directory may be read-only)
+            out = None
+            cache = False
+    if vocabulary is None and out is None:
+        fd, out = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+        np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=(count, dim)).flush()
+
+    pool = concurrent.futures.ProcessPoolExecutor(workers) if n > 1 else None
+    try:
+        mapper = map if pool is None else pool.map
+        lines = list(mapper(_count_lines, ranges)) if len(ranges) > 1 else [count]
+        jobs = []
+        row = 0
+        for (_, start, end), n_lines in zip(ranges, lines):
+            if row < count:
+                jobs.append((path, start, end, row, min(n_lines, count - row), dim, dtype, encoding, vocabulary, out))
+            row += n_lines
+        results = list(mapper(_parse_range, jobs))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    words = [word for result in results for word in result[0]]
+    if vocabulary is not None:
+        matrix = [result[1] for result in results]
+        return words, np.concatenate(matrix) if matrix else np.empty((0, dim), dtype=dtype)
+    if len(words) != count:
+        os.remove(out)
+        raise ValueError('Expected {0} embeddings in {1} but found {2}'.format(count, path, len(words)))
+    if cache:
+        try:
+            _write_cache(path, encoding, words, out, threshold)
+            return words, np.load(_cache_matrix(path, dtype), mmap_mode='c')
+        except OSError:
+            if not os.path.exists(out):
+                return words, np.load(_cache_matrix(path, dtype))
+    matrix = np.load(out)
+    os.remove(out)
+    return words, matrix
+
+
+def _count_lines(args):
+    path, start, end = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return data.count(b'\n') + (0 if data.endswith(b'\n') else 1)
+
+
+def _parse_range(args):
+    path, start, end, row, n_rows, dim, dtype, encoding, vocabulary, out = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b'\n', n_rows)[:n_rows]
+    words = []
+    vecs = []
+    for line in lines:
+        word, vec = line.split(b' ', 1)
+        word = word.decode(encoding, errors='surrogateescape')
+        if vocabulary is None or word in vocabulary:
+            words.append(word)
+            vecs.append(vec)
+    matrix = _parse_block(b' '.join(vecs), len(vecs), dim, dtype)
+    if out is None:
+        return words, matrix
+    m = np.load(out, mmap_mode='r+')
+    m[row:row+len(words)] = matrix
+    m.flush()
+    del m
+    return words, None
+
+
+# Binary sidecar cache: FILE.vocab holds the size and mtime of FILE followed by its
+# newline-terminated words, and FILE.<dtype>.npy holds its matrix. Both of them are
+# memory-mapped on load. A read with a threshold only caches the embeddings it asks for,
+# recording their number after the mtime, and a later read with a larger threshold (or
+# none) parses the file again.
+# The mapping is copy-on-write, so callers can still normalize the matrix in place.
+
+CACHE_DTYPES = ('float16', 'float32', 'float64')
+
+
+def _path(file):
+    name = getattr(file, 'name', None)
+    return name if isinstance(name, str) and os.path.isfile(name) else None
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return '{0} {1}'.format(st.st_size, st.st_mtime_ns)
+
+
+def _cache_matrix(path, dtype):
+    return '{0}.{1}.npy'.format(path, np.dtype(dtype).name)
+
+
+def _cache_tmp(path):
+    return '{0}.{1}.tmp.npy'.format(path, os.getpid())
+
+
+def _cache_stamp(path, words, threshold):
+    """Return the first line of FILE.vocab, with the number of words if they are only a prefix of path"""
+    stamp = _stamp(path)
+    return stamp if threshold <= 0 or len(words) < threshold else '{0} {1}'.format(stamp, len(words))
+
+
+def _read_cache(path, encoding, dtype, threshold=0):
+    try:
+        with open(path + '.vocab', 'rb') as f:
+            stamp = f.readline().decode('ascii').split()
+            if ' '.join(stamp[:2]) != _stamp(path) or not os.path.isfile(_cache_matrix(path, dtype)):
+                return None, None
+            if len(stamp) > 2 and not 0 < threshold <= int(stamp[2]):  # Only a prefix is cached
+                return None, None
+            offset = f.tell()
+        words = Vocabulary.from_buffer(np.memmap(path + '.vocab', dtype=np.uint8, mode='r', offset=offset), encoding)
+        matrix = np.load(_cache_matrix(path, dtype), mmap_mode='c')
+    except (OSError, ValueError):
+        return None, None
+    if matrix.shape[0] != len(words):
+        return None, None
+    return words, matrix
+
+
+def _save_cache(path, encoding, words, matrix, threshold=0):
+    try:
+        np.save(_cache_tmp(path), matrix)
+        _write_cache(path, encoding, words, _cache_tmp(path), threshold)
+        return words, np.load(_cache_matrix(path, matrix.dtype), mmap_mode='c')
+    except OSError:  # The cache is only an optimization (e.g. the directory may be read-only)
+        return words, matrix
+
+
+def _write_cache(path, encoding, words, tmp, threshold=0):
+    """Move the matrix saved in tmp into the cache of path, and store its words"""
+    stamp = _cache_stamp(path, words, threshold)
+    try:
+        with open(path + '.vocab', 'rb') as f:
+            fresh = f.readline().decode('ascii').strip() == stamp
+    except (OSError, UnicodeDecodeError):
+        fresh = False
+    if not fresh:
+        for dtype in CACHE_DTYPES:
+            if os.path.exists(_cache_matrix(path, dtype)):
+                os.remove(_cache_matrix(path, dtype))
+    os.replace(tmp, _cache_matrix(path, np.load(tmp, mmap_mode='r').dtype))
+    if not fresh:
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write((stamp + '\n').encode('ascii'))
+            f.write(Vocabulary(words, encoding).tobytes())
+        os.replace(tmp, path + '.vocab')
+
+
+# Byte-offset index: FILE.index.npz holds the size and mtime of FILE, its words and the
+# byte offset of each vector, so that reads restricted to a vocabulary can seek straight
+# to the entries they need. It is only used when the full matrix is not cached already.
+
+def _read_indexed(path, encoding, format, threshold, vocabulary, dtype):
+    words, offsets, dim = _read_index(path, encoding, format)
+    if threshold > 0:
+        words = words[:threshold]
+    ind = np.flatnonzero(Vocabulary(vocabulary, encoding).lookup(words) >= 0)
+    with open(path, 'rb') as f:
+        vecs = []
+        for i in ind:
+            f.seek(offsets[i])
+            vecs.append(f.read(4*dim) if format == 'bin' else f.readline())
+    if format == 'bin':
+        matrix = np.frombuffer(b''.join(vecs), dtype='<f4').reshape(len(ind), dim).astype(dtype)
+    else:
+        matrix = _parse_block(b' '.join(vecs), len(ind), dim, dtype)
+    return words[ind], matrix
+
+
+def _read_index(path, encoding, format):
+    try:
+        with np.load(path + '.index.npz') as index:
+            words = Vocabulary.from_buffer(index['words'], encoding)
+            if str(index['stamp']) == _stamp(path) and len(words) == len(index['offsets']):
+                return words, index['offsets'], int(index['dim'])
+    except (OSError, ValueError, KeyError):
+        pass
+    words, offsets, dim = _build_index(path, format)
+    words = Vocabulary.from_buffer(b''.join([word + b'\n' for word in words]), encoding)
+    try:
+        tmp = '{0}.{1}.tmp.npz'.format(path, os.getpid())
+        np.savez(tmp, stamp=_stamp(path), words=words.data, offsets=offsets, dim=dim)
+        os.replace(tmp, path + '.index.npz')
+    except OSError:
+        pass  # The index is only an optimization (e.g. the directory may be read-only)
+    return words, offsets, dim
+
+
+def _build_index(path, format):
+    words = []
+    offsets = []
+    with open(path, 'rb') as f:
+        count, dim = read_header(f, 'bin')
+        pos = f.tell()
+        if format == 'bin':
+            while len(words) < count:
+                f.seek(pos)
+                head = f.read(1024)
+                space = head.find(b' ')
+                while space < 0 and len(head) % 1024 == 0 and head:
+                    head += f.read(1024)
+                    space = head.find(b' ')
+                if space < 0:
+                    raise ValueError('Expected {0} embeddings in {1} but found {2}'.format(count, path, len(words)))
+                words.append(head[:space].lstrip(b'\n'))
+                offsets.append(pos + space + 1)
+                pos += space + 1 + 4*dim
+        else:
+            for line in f:
+                if len(words) == count:
+                    break
+                word = line.split(b' ', 1)[0]
+                words.append(word)
+                offsets.append(pos + len(word) + 1)
+                pos += len(line)
+    return words, np.array(offsets, dtype=np.int64), dim
+
+
+def write_header(count, dim, file, format='text', scale=None):
+    compression = _compression_from_name(file)
+    if compression is not None:
+        with _compress(file, compression) as f:
+            write_header(count, dim, f, format, scale)
+    elif format == 'text':
+        print('%d %d' % (count, dim), file=file)
+    elif format == 'bin':
+        file.flush()
+        _binary(file).write(('%d %d\n' % (count, dim)).encode('ascii'))
+    else:
+        if format == 'int8dim' and scale is None:
+            raise ValueError('The int8dim format requires the per-dimension scale')
+        file.flush()
+        _binary(file).write(('%d %d %s\n' % (count, dim, format)).encode('ascii'))
+        if format == 'int8dim':
+            _binary(file).write(np.asarray(scale, dtype='<f4').tobytes() + b'\n')
+
+
+def write(words, matrix, file, format='text', workers=None, header=True, pool=None):
+    compression = _compression_from_name(file)
+    if compression is not None:
+        with _compress(file, compression) as f:
+            write(words, matrix, f, format, workers, header, pool)
+        return
+    if isinstance(matrix, Quantized) and matrix.quantization != format:
+        matrix = matrix.dequantize()
+    if format in QUANTIZATIONS:
+        m = matrix if isinstance(matrix, Quantized) else quantize(matrix, format)
+        if format == 'int8dim' and not header and m is not matrix:
+            raise ValueError('The int8dim format requires quantizing all the embeddings with the scale in the header')
+    else:
+        m = asnumpy(matrix)
+    if header:
+        write_header(m.shape[0], m.shape[1], file, format, m.scale if format == 'int8dim' else None)
+    if format != 'text':
+        file.flush()
+        _write_binary(words, m, _binary(file), _encoding(file))
+        return
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    blocks = [(words[i:i+WRITE_BATCH_SIZE], m[i:i+WRITE_BATCH_SIZE]) for i in range(0, len(words), WRITE_BATCH_SIZE)]
+    if pool is not None:  # An executor shared with other calls (e.g. across the batches of a stream)
+        for text in pool.map(_format_rows, blocks):
+            file.write(text)
+    elif workers <= 1 or len(blocks) <= 1:
+        for block in blocks:
+            file.write(_format_rows(block))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            for text in pool.map(_format_rows, blocks):
+                file.write(text)
+
+
+# Rows are formatted in blocks with a single %-format per row, in a process pool as the
+# formatting holds the GIL. This gives the exact same output as '%.6g' % x for each x.
+
+WRITE_BATCH_SIZE = 2000
+
+
+def _format_rows(block):
+    words, m = block
+    fmt = ' '.join(['%.6g'] * m.shape[1])
+    return ''.join([word + ' ' + fmt % tuple(row) + '\n' for word, row in zip(words, m.tolist())])
 
 
 def length_normalize(matrix):
-    xp = get_array_module(matrix)
-    norms = xp.sqrt(xp.sum(matrix**2, axis=1))
-    norms[norms == 0] = 1
-    matrix /= norms[:, xp.newaxis]
+    normalize(matrix, ['unit'])
 
 
 def mean_center(matrix):
-    xp = get_array_module(matrix)
-    avg = xp.mean(matrix, axis=0)
-    matrix -= avg
+    normalize(matrix, ['center'])
 
 
 def length_normalize_dimensionwise(matrix):
-    xp = get_array_module(matrix)
-    norms = xp.sqrt(xp.sum(matrix**2, axis=0))
-    norms[norms == 0] = 1
-    matrix /= norms
+    normalize(matrix, ['unitdim'])
 
 
 def mean_center_embeddingwise(matrix):
+    normalize(matrix, ['centeremb'])
+
+
+# Normalization runs in blocked passes over the rows. Column-wise actions (center, unitdim)
+# are not applied right away, but folded into a pending per-dimension affine map computed
+# from the column statistics gathered in the previous pass, which is applied on the fly by
+# the next pass together with any row-wise actions (unit, centeremb). This way, ['unit',
+# 'center', 'unit'] takes two passes, and no full-size temporary is created. The statistics
+# are the column means and sums of squared deviations from them, computed around a shift
+# within each block and merged across blocks in float64 as in Chan et al. (1979), so that
+# large means do not cancel out the variance.
+# As a result, memory-mapped matrices are normalized out of core, either in place or into a
+# new .npy file, without ever holding them in memory.
+
+NORMALIZE_BATCH_SIZE = 1024
+
+
+def normalize(matrix, actions, out=None):
+    """
+    Perform the given normalization actions in order, in place or into out (which is returned).
+    If out is a file name, the result is written into a new .npy file and returned memory-mapped.
+    """
     xp = get_array_module(matrix)
-    avg = xp.mean(matrix, axis=1)
-    matrix -= avg[:, xp.newaxis]
-
-
-def normalize(matrix, actions):
-    for action in actions:
-        if action == 'unit':
-            length_normalize(matrix)
-        elif action == 'center':
-            mean_center(matrix)
-        elif action == 'unitdim':
-            length_normalize_dimensionwise(matrix)
-        elif action == 'centeremb':
-            mean_center_embeddingwise(matrix)
+    if isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=matrix.dtype, shape=matrix.shape)
+    out = matrix if out is None else out
+    n, dim = matrix.shape
+    src = matrix
+    scale = offset = None  # The normalized matrix is (src - offset)*scale
+    stats = None  # Column means and sums of squared deviations from them of src
+    pending = []  # Row-wise actions to apply in the next pass
+    actions = [action for action in actions if action in ('unit', 'center', 'unitdim', 'centeremb')]
+    for k, action in enumerate(actions):
+        if action in ('unit', 'centeremb'):
+            pending.append(action)
+            if k + 1 < len(actions) and actions[k+1] in ('unit', 'centeremb'):
+                continue
+            collect = any(a in ('center', 'unitdim') for a in actions[k+1:])
+            stats = _normalize_pass(xp, src, out, scale, offset, pending, collect)
+            src, scale, offset, pending = out, None, None, []
+            continue
+        if stats is None:
+            stats = _normalize_pass(xp, src, None, None, None, [], True)
+        if scale is None:
+            scale, offset = xp.ones(dim), xp.zeros(dim)
+        mean, m2 = stats
+        if action == 'center':
+            offset = mean.copy()
+        else:
+            norms = scale * xp.sqrt(m2 + n*(mean - offset)**2)
+            norms[norms == 0] = 1
+            scale /= norms
+    if scale is not None or src is not out:
+        _normalize_pass(xp, src, out, scale, offset, [], False)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+def _normalize_pass(xp, src, out, scale, offset, actions, collect):
+    n, dim = src.shape
+    dtype = src.dtype if out is None else out.dtype
+    if scale is not None:  # The offset is split in two terms in dtype, which subtract it as precisely as float64
+        scale, offset, remainder = scale.astype(dtype), offset.astype(dtype), (offset - offset.astype(dtype)).astype(dtype)
+    rows = xp.empty(NORMALIZE_BATCH_SIZE, dtype=dtype)
+    cols = xp.empty(dim, dtype=dtype)
+    devs = xp.empty((NORMALIZE_BATCH_SIZE, dim), dtype=dtype) if collect else None
+    mean = xp.zeros(dim)
+    m2 = xp.zeros(dim)
+    for i in range(0, n, NORMALIZE_BATCH_SIZE):
+        j = min(i + NORMALIZE_BATCH_SIZE, n)
+        block = src[i:j] if out is None else out[i:j]
+        if scale is not None:
+            xp.subtract(src[i:j], offset, out=block)
+            block -= remainder
+            block *= scale
+        elif out is not None and src is not out:
+            block[...] = src[i:j]
+        for action in actions:
+            if action == 'unit':
+                norms = _sum_squares(xp, block, 1, rows[:j-i])
+                xp.sqrt(norms, out=norms)
+                norms[norms == 0] = 1
+                block /= norms[:, xp.newaxis]
+            else:  # centeremb
+                avg = xp.sum(block, axis=1, out=rows[:j-i])
+                avg /= dim
+                block -= avg[:, xp.newaxis]
+        if collect:
+            # Moments of the block around the mean of the previous ones (or its first row), merged in float64
+            shift = (mean if i > 0 else block[0]).astype(dtype)
+            dev = xp.subtract(block, shift, out=devs[:j-i])
+            total = xp.sum(dev, axis=0, out=cols).astype(xp.float64)
+            block_mean = shift + total/(j-i)
+            block_m2 = xp.maximum(_sum_squares(xp, dev, 0, cols) - total*total/(j-i), 0)
+            delta = block_mean - mean
+            mean += delta * ((j-i) / j)
+            m2 += block_m2 + delta*delta * (i*(j-i) / j)
+    return (mean, m2) if collect else None
+
+
+def _sum_squares(xp, block, axis, out):
+    if xp is np:
+        return np.einsum('ij,ij->i' if axis == 1 else 'ij,ij->j', block, block, out=out)
+    return xp.sum(block*block, axis=axis, out=out)
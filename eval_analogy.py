@@ -32,6 +32,7 @@ def main():
     parser.add_argument('-v', '--verbose', action='store_true', help='verbose output (give category specific results)')
     parser.add_argument('-l', '--lowercase', action='store_true', help='lowercase the words in the test file')
     parser.add_argument('--encoding', default='utf-8', help='the character encoding for input/output (defaults to utf-8)')
+    parser.add_argument('--format', choices=['auto', 'text', 'bin', 'fp16', 'int8', 'int8dim'], default='auto', help='the format of the input embeddings (text: word2vec text; bin: word2vec binary; fp16/int8/int8dim: quantized; defaults to auto, which detects it)')
     parser.add_argument('--precision', choices=['fp16', 'fp32', 'fp64'], default='fp32', help='the floating-point precision (defaults to fp32)')
     args = parser.parse_args()
 
@@ -45,10 +46,7 @@ def main():
 
     # Read input embeddings
     f = open(args.embeddings, encoding=args.encoding, errors='surrogateescape')
-    words, matrix = embeddings.read(f, threshold=args.threshold, dtype=dtype)
-
-    # Build word to index map
-    word2ind = {word: i for i, word in enumerate(words)}
+    words, matrix = embeddings.read(f, threshold=args.threshold, dtype=dtype, format=args.format)
 
     # Length normalize embeddings
     embeddings.length_normalize(matrix)
@@ -56,25 +54,33 @@ def main():
     # Parse test file
     f = open(args.input, encoding=args.encoding, errors='surrogateescape')
     categories = []
-    src1 = []
-    trg1 = []
-    src2 = []
-    trg2 = []
+    questions = []
     for line in f:
         if line.startswith(': '):
             name = line[2:-1]
             is_syntactic = name.startswith('gram')
             categories.append({'name': name, 'is_syntactic': is_syntactic, 'total': 0, 'oov': 0})
         else:
-            try:
-                ind = [word2ind[word.lower() if args.lowercase else word] for word in line.split()]
-                src1.append(ind[0])
-                trg1.append(ind[1])
-                src2.append(ind[2])
-                trg2.append(ind[3])
-                categories[-1]['total'] += 1
-            except KeyError:
-                categories[-1]['oov'] += 1
+            questions.append((categories[-1], [word.lower() if args.lowercase else word for word in line.split()]))
+
+    # Look up all the words in the test file at once
+    ind = words.lookup([word for category, question in questions for word in question]).tolist()
+    src1 = []
+    trg1 = []
+    src2 = []
+    trg2 = []
+    i = 0
+    for category, question in questions:
+        question_ind = ind[i:i+len(question)]
+        i += len(question)
+        if min(question_ind) < 0:
+            category['oov'] += 1
+        else:
+            src1.append(question_ind[0])
+            trg1.append(question_ind[1])
+            src2.append(question_ind[2])
+            trg2.append(question_ind[3])
+            category['total'] += 1
     total = len(src1)
 
     # Compute nearest neighbors using efficient matrix multiplication
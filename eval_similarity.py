@@ -31,6 +31,7 @@ def main():
     parser.add_argument('-l', '--lowercase', action='store_true', help='lowercase the words in the test files')
     parser.add_argument('--backoff', default=None, type=float, help='use a backoff similarity score for OOV entries')
     parser.add_argument('--encoding', default='utf-8', help='the character encoding for input/output (defaults to utf-8)')
+    parser.add_argument('--format', choices=['auto', 'text', 'bin', 'fp16', 'int8', 'int8dim'], default='auto', help='the format of the input embeddings (text: word2vec text; bin: word2vec binary; fp16/int8/int8dim: quantized; defaults to auto, which detects it)')
     parser.add_argument('--precision', choices=['fp16', 'fp32', 'fp64'], default='fp32', help='the floating-point precision (defaults to fp32)')
     parser.add_argument('--sim', nargs='*', help='the names of the datasets to include in the similarity results')
     parser.add_argument('--rel', nargs='*', help='the names of the datasets to include in the relatedness results')
@@ -66,34 +67,31 @@ def main():
     # Read embeddings
     srcfile = open(args.src_embeddings, encoding=args.encoding, errors='surrogateescape')
     trgfile = open(args.src_embeddings if args.trg_embeddings is None else args.trg_embeddings, encoding=args.encoding, errors='surrogateescape')
-    src_words, src_matrix = embeddings.read(srcfile, vocabulary=src_vocab, dtype=dtype)
-    trg_words, trg_matrix = embeddings.read(trgfile, vocabulary=trg_vocab, dtype=dtype)
+    src_words, src_matrix = embeddings.read(srcfile, vocabulary=src_vocab, dtype=dtype, format=args.format)
+    trg_words, trg_matrix = embeddings.read(trgfile, vocabulary=trg_vocab, dtype=dtype, format=args.format)
 
     # Length normalize embeddings so their dot product effectively computes the cosine similarity
     embeddings.length_normalize(src_matrix)
     embeddings.length_normalize(trg_matrix)
 
-    # Build word to index map
-    src_word2ind = {word: i for i, word in enumerate(src_words)}
-    trg_word2ind = {word: i for i, word in enumerate(trg_words)}
-
     # Compute system scores and correlations
     results = []
     for i in range(len(golds)):
         system = []
         gold = []
         oov = 0
-        for gold_score, (src, trg) in zip(golds[i], word_pairs[i]):
-            try:
-                cos = np.dot(src_matrix[src_word2ind[src]], trg_matrix[trg_word2ind[trg]])
+        src_ind = src_words.lookup([src for src, trg in word_pairs[i]]).tolist()
+        trg_ind = trg_words.lookup([trg for src, trg in word_pairs[i]]).tolist()
+        for gold_score, src_i, trg_i in zip(golds[i], src_ind, trg_ind):
+            if src_i >= 0 and trg_i >= 0:
+                cos = np.dot(src_matrix[src_i], trg_matrix[trg_i])
                 system.append(cos)
                 gold.append(gold_score)
-            except KeyError:
-                if args.backoff is None:
-                    oov += 1
-                else:
-                    system.append(args.backoff)
-                    gold.append(gold_score)
+            elif args.backoff is None:
+                oov += 1
+            else:
+                system.append(args.backoff)
+                gold.append(gold_score)
         name = os.path.splitext(os.path.basename(args.input[i]))[0]
         coverage = len(system) / (len(system) + oov)
         pearson = scipy.stats.pearsonr(gold, system)[0]
@@ -18,31 +18,15 @@ from cupy_utils import *
 
 import argparse
 import collections
+import lsh
 import numpy as np
+import retrieval
 import sys
 
 
 BATCH_SIZE = 500
 
 
-def topk_mean(m, k, inplace=False):  # TODO Assuming that axis is 1
-    xp = get_array_module(m)
-    n = m.shape[0]
-    ans = xp.zeros(n, dtype=m.dtype)
-    if k <= 0:
-        return ans
-    if not inplace:
-        m = xp.array(m)
-    ind0 = xp.arange(n)
-    ind1 = xp.empty(n, dtype=int)
-    minimum = m.min()
-    for i in range(k):
-        m.argmax(axis=1, out=ind1)
-        ans += m[ind0, ind1]
-        m[ind0, ind1] = minimum
-    return ans / k
-
-
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Evaluate embeddings of two languages in a shared space in word translation induction')
@@ -53,8 +37,12 @@ def main():
     parser.add_argument('--inv_temperature', default=1, type=float, help='the inverse temperature (only compatible with inverted softmax)')
     parser.add_argument('--inv_sample', default=None, type=int, help='use a random subset of the source vocabulary for the inverse computations (only compatible with inverted softmax)')
     parser.add_argument('-k', '--neighborhood', default=10, type=int, help='the neighborhood size (only compatible with csls)')
+    parser.add_argument('--csls_lsh', type=int, default=0, metavar='BITS', help='estimate the neighborhood means with sign random projection LSH using hashes of this many bits, reporting their mean absolute error on a sample (only compatible with csls; defaults to 0, which computes them exactly)')
+    parser.add_argument('--csls_lsh_tables', type=int, default=16, help='the number of LSH hash tables for --csls_lsh (defaults to 16)')
     parser.add_argument('--dot', action='store_true', help='use the dot product in the similarity computations instead of the cosine')
     parser.add_argument('--encoding', default='utf-8', help='the character encoding for input/output (defaults to utf-8)')
+    parser.add_argument('--format', choices=['auto', 'text', 'bin', 'fp16', 'int8', 'int8dim'], default='auto', help='the format of the input embeddings (text: word2vec text; bin: word2vec binary; fp16/int8/int8dim: quantized; defaults to auto, which detects it)')
+    parser.add_argument('--tile_memory', type=float, default=None, help='the memory budget in MB for the similarity matrix tiles and their temporaries (only compatible with nn and csls; defaults to %d full rows)' % BATCH_SIZE)
     parser.add_argument('--seed', type=int, default=0, help='the random seed')
     parser.add_argument('--precision', choices=['fp16', 'fp32', 'fp64'], default='fp32', help='the floating-point precision (defaults to fp32)')
     parser.add_argument('--cuda', action='store_true', help='use cuda (requires cupy)')
@@ -71,8 +59,8 @@ def main():
     # Read input embeddings
     srcfile = open(args.src_embeddings, encoding=args.encoding, errors='surrogateescape')
     trgfile = open(args.trg_embeddings, encoding=args.encoding, errors='surrogateescape')
-    src_words, x = embeddings.read(srcfile, dtype=dtype)
-    trg_words, z = embeddings.read(trgfile, dtype=dtype)
+    src_words, x = embeddings.read(srcfile, dtype=dtype, format=args.format)
+    trg_words, z = embeddings.read(trgfile, dtype=dtype, format=args.format)
 
     # NumPy/CuPy management
     if args.cuda:
@@ -91,23 +79,19 @@ def main():
         embeddings.length_normalize(x)
         embeddings.length_normalize(z)
 
-    # Build word to index map
-    src_word2ind = {word: i for i, word in enumerate(src_words)}
-    trg_word2ind = {word: i for i, word in enumerate(trg_words)}
-
     # Read dictionary and compute coverage
     f = open(args.dictionary, encoding=args.encoding, errors='surrogateescape')
+    pairs = [line.split() for line in f]
+    src_ind = src_words.lookup([src for src, trg in pairs]).tolist()
+    trg_ind = trg_words.lookup([trg for src, trg in pairs]).tolist()
     src2trg = collections.defaultdict(set)
     oov = set()
     vocab = set()
-    for line in f:
-        src, trg = line.split()
-        try:
-            src_ind = src_word2ind[src]
-            trg_ind = trg_word2ind[trg]
-            src2trg[src_ind].add(trg_ind)
+    for (src, trg), src_i, trg_i in zip(pairs, src_ind, trg_ind):
+        if src_i >= 0 and trg_i >= 0:
+            src2trg[src_i].add(trg_i)
             vocab.add(src)
-        except KeyError:
+        else:
             oov.add(src)
     src = list(src2trg.keys())
     oov -= vocab  # If one of the translation options is in the vocabulary, then the entry is not an oov
@@ -115,13 +99,11 @@ def main():
 
     # Find translations
     translation = collections.defaultdict(int)
+    tile_memory = None if args.tile_memory is None else int(args.tile_memory * 1024**2)
     if args.retrieval == 'nn':  # Standard nearest neighbor
-        for i in range(0, len(src), BATCH_SIZE):
-            j = min(i + BATCH_SIZE, len(src))
-            similarities = x[src[i:j]].dot(z.T)
-            nn = similarities.argmax(axis=1).tolist()
-            for k in range(j-i):
-                translation[src[i+k]] = nn[k]
+        _, nn, _, _ = retrieval.nearest_neighbors(x[src], z, BATCH_SIZE, backward=False, memory=tile_memory)
+        for i, k in enumerate(nn.tolist()):
+            translation[src[i]] = k
     elif args.retrieval == 'invnn':  # Inverted nearest neighbor
         best_rank = np.full(len(src), x.shape[0], dtype=int)
         best_sim = np.full(len(src), -100, dtype=dtype)
@@ -152,16 +134,20 @@ def main():
             for k in range(j-i):
                 translation[src[i+k]] = nn[k]
     elif args.retrieval == 'csls':  # Cross-domain similarity local scaling
-        knn_sim_bwd = xp.zeros(z.shape[0])
-        for i in range(0, z.shape[0], BATCH_SIZE):
-            j = min(i + BATCH_SIZE, z.shape[0])
-            knn_sim_bwd[i:j] = topk_mean(z[i:j].dot(x.T), k=args.neighborhood, inplace=True)
-        for i in range(0, len(src), BATCH_SIZE):
-            j = min(i + BATCH_SIZE, len(src))
-            similarities = 2*x[src[i:j]].dot(z.T) - knn_sim_bwd  # Equivalent to the real CSLS scores for NN
-            nn = similarities.argmax(axis=1).tolist()
-            for k in range(j-i):
-                translation[src[i+k]] = nn[k]
+        if args.csls_lsh > 0:
+            lsh_index = lsh.LSHIndex(asnumpy(x), args.csls_lsh, args.csls_lsh_tables, seed=args.seed)
+            knn_sim_bwd = lsh.knn_means(lsh_index, asnumpy(z), args.neighborhood)
+            mean_error, max_error = lsh.error(lsh_index, asnumpy(z), args.neighborhood, knn_sim_bwd, seed=args.seed)
+            print('LSH mean absolute error in the neighborhood means: {0:.4f} (max {1:.4f})'.format(mean_error, max_error), file=sys.stderr)
+            knn_sim_bwd = xp.asarray(knn_sim_bwd)
+            if mean_error > lsh.LSH_TOLERANCE:
+                print('WARNING: The LSH error is above {0}, computing the neighborhood means exactly (use fewer bits or more tables)'.format(lsh.LSH_TOLERANCE), file=sys.stderr)
+                _, knn_sim_bwd = retrieval.knn_means(x, z, args.neighborhood, BATCH_SIZE, rows=False, memory=tile_memory)
+        else:
+            _, knn_sim_bwd = retrieval.knn_means(x, z, args.neighborhood, BATCH_SIZE, rows=False, memory=tile_memory)
+        _, nn, _, _ = retrieval.nearest_neighbors(x[src], z, BATCH_SIZE, knn_bwd=knn_sim_bwd, backward=False, memory=tile_memory)
+        for i, k in enumerate(nn.tolist()):
+            translation[src[i]] = k
 
     # Compute accuracy
     accuracy = np.mean([1 if translation[i] in src2trg[i] else 0 for i in src])
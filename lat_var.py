@@ -1,85 +1,199 @@
+from cupy_utils import *
+
+import auction
+import concurrent.futures
+import heapq
 import numpy as np
+import os
+import scipy.sparse
 from lap import lapmod
+from scipy.sparse import csgraph
 
 
-def lat_var(xp, sims, n_similar, n_repeats, batch_size, asym):
+def lat_var(xp, sims, n_similar, n_repeats, batch_size, asym, solver='lapmod', components=False, workers=None, pool=None):
     """
     Run the matching in the E-step of the latent-variable model.
     :param xp: numpy or cupy, depending whether we run on CPU or GPU.
-    :param xw: the xw matrix
-    :param zw: the zw matrix
     :param sims: an matrix of shape (src_size, trg_size) where the similarity values
                  between each source word and target words are stored
-    :param best_sim_forward: an array of shape (src_size), which stores the best similarity
-                             scores for each
-    :param n_similar:
-    :param n_repeats:
-    :param batch_size:
-    :param asym:
-    :return:
+    :param n_similar: the number of most similar targets of each source word that can be matched to it
+    :param n_repeats: repeats the words to get 2:2, 3:3, etc. alignments
+    :param batch_size: the number of rows of sims that are processed at once
+    :param asym: 1:2 or 2:1 for asymmetric matching
+    :param solver: the assignment solver (lapmod or auction)
+    :param components: solve each connected component of the candidate graph separately
+    :param workers: the number of processes for the components (defaults to the number of CPUs)
+    :param pool: a process pool from worker_pool to solve the components in, kept across calls
+    :return: the matched source and target indices
+    """
+    values, indices = sparse_candidates(xp, sims, n_similar, batch_size)
+    return match(xp, *sparse_costs(values, indices, n_repeats, asym), n_similar, sims.shape[0], solver, components, workers, pool)
+
+
+def sparse_candidates(xp, sims, n_similar, batch_size):
+    """
+    Return the similarities and indices of the n_similar most similar targets of each source word,
+    as arrays of shape (src_size, n_similar). They can also be collected without a dense sims matrix
+    with the top_fwd and top_bwd arguments of retrieval.nearest_neighbors.
     """
     src_size = sims.shape[0]
-    cc = np.empty(src_size * n_similar)  # 1D array of all finite elements of the assignement cost matrix
-    kk = np.empty(src_size * n_similar)  # 1D array of the column indices. Must be sorted within one row.
-    ii = np.empty((src_size * n_repeats + 1,), dtype=int)   # 1D array of indices of the row starts in cc.
-    ii[0] = 0
-    # if each src id should be matched to trg id, then we need to double the source indices
-    for i in range(1, src_size * n_repeats + 1):
-        ii[i] = ii[i - 1] + n_similar
+    values = xp.empty((src_size, n_similar), dtype=sims.dtype)
+    indices = xp.empty((src_size, n_similar), dtype=int)
     for i in range(0, src_size, batch_size):
-        # j = min(x.shape[0], i + batch_size)
         j = min(i + batch_size, src_size)
-        sim = sims[i:j]
-
-        trg_indices = xp.argpartition(sim, -n_similar)[:, -n_similar:]  # get indices of n largest elements
-        if xp != np:
-            trg_indices = xp.asnumpy(trg_indices)
-        trg_indices.sort()  # sort the target indices
-
-        trg_indices = trg_indices.flatten()
-        row_indices = np.array([[i] * n_similar for i in range(j-i)]).flatten()
-        sim_scores = sim[row_indices, trg_indices]
-        costs = 1 - sim_scores
-        if xp != np:
-            costs = xp.asnumpy(costs)
-        cc[i * n_similar:j * n_similar] = costs
-        kk[i * n_similar:j * n_similar] = trg_indices
-    if n_repeats > 1:
-        # duplicate costs and target indices
-        new_cc = cc
-        new_kk = kk
-        for i in range(1, n_repeats):
-            new_cc = np.concatenate([new_cc, cc], axis=0)
-            if asym == '1:2':
-                # for 1:2, we don't duplicate the target indices
-                new_kk = np.concatenate([new_kk, kk], axis=0)
-            else:
-                # update target indices so that they refer to new columns
-                new_kk = np.concatenate([new_kk, kk + src_size * i], axis=0)
-        cc = new_cc
-        kk = new_kk
+        indices[i:j] = xp.argpartition(sims[i:j], -n_similar, axis=1)[:, -n_similar:]
+        values[i:j] = xp.take_along_axis(sims[i:j], indices[i:j], axis=1)
+    return values, indices
+
+
+def sparse_costs(values, indices, n_repeats, asym):
+    """
+    Build the sparse assignment cost matrix of the matching in the format of lapmod from the
+    similarities and indices of the candidate targets of each source word (see sparse_candidates).
+    :return: the costs (cc), their column indices (kk, sorted within each row) and the row starts (ii)
+             for src_size * n_repeats rows
+    """
+    values, indices = asnumpy(values), asnumpy(indices)
+    src_size, n_similar = indices.shape
+    order = np.argsort(indices, axis=1)
+    cc = (1 - np.take_along_axis(values, order, axis=1)).ravel().astype(np.float64)
+    kk = np.take_along_axis(indices, order, axis=1).ravel()
+    # Each source word is repeated n_repeats times, and so is each target word (as a new column) unless asym is 1:2
+    offsets = np.zeros(n_repeats, dtype=int) if asym == '1:2' else np.arange(n_repeats) * src_size
+    kk = (kk + offsets[:, np.newaxis]).ravel()
+    cc = np.tile(cc, n_repeats)
+    ii = np.arange(src_size * n_repeats + 1) * n_similar
+    return cc, kk, ii
+
+
+def match(xp, cc, kk, ii, n_similar, src_size, solver='lapmod', components=False, workers=None, pool=None):
+    """
+    Solve the sparse assignment problem built by sparse_costs with lapmod or auction.solve,
+    returning the matched source and target indices. The problem is usually infeasible, so the rows
+    that cannot be matched to one of their candidates are left unmatched, each at a higher cost than
+    any candidate (see _complete). If components, the connected components of the candidate graph
+    are solved as independent problems in a pool of worker processes (a new one unless pool is given),
+    which gives the same matching.
+    """
     # trg indices are targets assigned to each row id from 0-(n_rows-1)
-    cost, trg_indices, _ = lapmod(src_size * n_repeats, cc, ii, kk)
-    src_indices = np.concatenate([np.arange(src_size)] * n_repeats, 0)
-    src_indices, trg_indices = xp.asarray(src_indices), xp.asarray(trg_indices)
-
-    # remove the pairs in which a source word was connected to a target
-    # which was not one of its k most similar words
-    wrong_inds = []
-    for i, trgind in enumerate(trg_indices):
-        krow = ii[i]
-        candidates = kk[krow:krow + n_similar]
-        if trgind not in candidates:
-            wrong_inds.append(i)
-    trg_indices = np.delete(trg_indices, wrong_inds)
-    src_indices = np.delete(src_indices, wrong_inds)
-
-    for i in range(len(src_indices)):
-        src_idx, trg_idx = src_indices[i], trg_indices[i]
-        # we do this if args.n_repeats > 0 to assign the target
-        # indices in the cost matrix to the correct idx
-        while trg_idx >= src_size:
-            # if we repeat, we have indices that are > n_rows
-            trg_idx -= src_size
-            trg_indices[i] = trg_idx
-    return src_indices, trg_indices
+    if components:
+        trg_indices = _solve_components(cc, kk, ii, solver, workers, pool)
+    else:
+        trg_indices = _solve(cc, kk, ii, kk.max() + 1, solver, _unmatched_cost(cc))
+    src_indices, trg_indices = assignment_pairs(trg_indices, kk, n_similar, src_size)
+    return xp.asarray(src_indices), xp.asarray(trg_indices)
+
+
+def connected_components(kk, ii):
+    """
+    Return the number of connected components of the bipartite graph between the rows and the
+    columns of a sparse cost matrix, and the component of each row and column
+    """
+    n, m = len(ii) - 1, kk.max() + 1
+    graph = scipy.sparse.csr_matrix((np.ones(len(kk), dtype=np.int8), kk, ii), shape=(n, m))
+    count, labels = csgraph.connected_components(scipy.sparse.bmat([[None, graph], [graph.T, None]]), directed=False)
+    return count, labels[:n], labels[n:]
+
+
+def worker_pool(workers=None):
+    """Return a pool of worker processes for match, or None if a single worker is requested"""
+    workers = workers or os.cpu_count()
+    return concurrent.futures.ProcessPoolExecutor(workers) if workers > 1 else None
+
+
+def _solve(cc, kk, ii, n_cols, solver, unmatched_cost, workers=None):
+    """Return the column assigned to each row, or -1 if it is left unmatched (auction uses this many threads)"""
+    n = len(ii) - 1
+    cc, kk, ii = _complete(cc, kk, ii, n_cols, unmatched_cost)
+    if solver == 'auction':
+        x = auction.solve(cc, kk, ii, workers=workers)[1]
+    elif solver == 'lapmod':
+        x = lapmod(len(ii) - 1, cc, ii, kk)[1]
+    else:
+        raise ValueError('Unknown assignment solver: ' + solver)
+    x = x[:n].astype(np.int64)
+    x[x >= n_cols] = -1
+    return x
+
+
+def _complete(cc, kk, ii, n_cols, unmatched_cost):
+    """
+    Extend a sparse assignment problem, which is usually infeasible, to a square one with a perfect
+    matching: each row i can also take a new column n_cols+i at unmatched_cost, and each column j
+    gets a new row that can take j or the new column of any row that has j as a candidate at no
+    cost. The optimal assignment of the extension matches the rows to their candidates with the
+    minimum cost, where each row left unmatched costs unmatched_cost.
+    """
+    n = len(ii) - 1
+    lengths = np.diff(ii)
+    rows = np.repeat(np.arange(n), lengths)
+    new_rows = np.concatenate((rows, np.arange(n), n + np.arange(n_cols), n + kk))
+    new_cols = np.concatenate((kk, n_cols + np.arange(n), np.arange(n_cols), n_cols + rows))
+    new_costs = np.concatenate((cc, np.full(n, unmatched_cost), np.zeros(n_cols + len(kk))))
+    order = np.lexsort((new_cols, new_rows))
+    ii = np.concatenate(([0], np.cumsum(np.bincount(new_rows, minlength=n + n_cols))))
+    return new_costs[order], new_cols[order], ii
+
+
+def _unmatched_cost(cc):
+    """Return the cost of leaving a row unmatched, which is higher than that of any candidate"""
+    return cc.max() + 1 if len(cc) > 0 else 1
+
+
+def _solve_components(cc, kk, ii, solver, workers=None, pool=None):
+    count, row_labels, col_labels = connected_components(kk, ii)
+    rows = np.argsort(row_labels, kind='stable')
+    cols = np.argsort(col_labels, kind='stable')
+    row_starts = np.concatenate(([0], np.cumsum(np.bincount(row_labels, minlength=count))))
+    col_starts = np.concatenate(([0], np.cumsum(np.bincount(col_labels, minlength=count))))
+    local = np.empty(len(col_labels), dtype=np.int64)
+    local[cols] = np.arange(len(cols)) - col_starts[col_labels[cols]]  # Index of each column within its component
+    lengths = np.diff(ii)
+
+    # Extract the problem of each component, and pack them in tasks of similar size for the workers
+    problems = []
+    for c in np.flatnonzero(row_starts[1:] > row_starts[:-1]):
+        r = rows[row_starts[c]:row_starts[c+1]]
+        entries = np.repeat(ii[r] - np.cumsum(lengths[r]) + lengths[r], lengths[r]) + np.arange(lengths[r].sum())
+        problems.append((r, cols[col_starts[c]:col_starts[c+1]],
+                         cc[entries], local[kk[entries]], np.concatenate(([0], np.cumsum(lengths[r])))))
+    workers = workers or os.cpu_count()
+    tasks = [[] for _ in range(min(4*workers, len(problems)))]
+    loads = [(0, t) for t in range(len(tasks))]  # A heap with the number of entries of each task
+    for i in np.argsort([-len(p[2]) for p in problems], kind='stable'):
+        load, t = loads[0]
+        tasks[t].append(problems[i])
+        heapq.heapreplace(loads, (load + len(problems[i][2]), t))
+    cost = _unmatched_cost(cc)
+    inputs = [[p[2:] + (len(p[1]),) for p in t] for t in tasks]
+    if pool is not None and len(tasks) > 1:
+        results = list(pool.map(_solve_task, inputs, [solver]*len(tasks), [cost]*len(tasks)))
+    elif workers > 1 and len(tasks) > 1:
+        with worker_pool(workers) as pool:
+            results = list(pool.map(_solve_task, inputs, [solver]*len(tasks), [cost]*len(tasks)))
+    else:
+        results = [_solve_task(t, solver, cost) for t in inputs]
+
+    # Merge the assignments of all components
+    x = np.full(len(ii) - 1, -1, dtype=np.int64)
+    for task, result in zip(tasks, results):
+        for (r, c, _, _, _), assignment in zip(task, result):
+            x[r] = np.where(assignment >= 0, c[assignment], -1)
+    return x
+
+
+def _solve_task(problems, solver, unmatched_cost):
+    # The tasks already run in parallel, so auction uses a single thread in each of them
+    return [_solve(cc, kk, ii, n_cols, solver, unmatched_cost, workers=1) for cc, kk, ii, n_cols in problems]
+
+
+def assignment_pairs(trg_indices, kk, n_similar, src_size):
+    """
+    Turn the target assigned to each row of the sparse cost matrix into (source, target) pairs,
+    removing the pairs in which a source word was connected to a target which was not one of its
+    n_similar most similar words, and folding the repeated target columns back to their word.
+    """
+    trg_indices = np.asarray(trg_indices)
+    src_indices = np.tile(np.arange(src_size), len(trg_indices) // src_size)
+    valid = (kk.reshape(-1, n_similar) == trg_indices[:, np.newaxis]).any(axis=1)
+    return src_indices[valid], trg_indices[valid] % src_size
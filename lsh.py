@@ -0,0 +1,141 @@
+import numpy as np
+import topk
+
+
+# Sign random projection LSH for estimating the CSLS neighborhood means: each hash table
+# assigns a vector to the bucket given by the signs of its projection on n_bits random
+# hyperplanes, so vectors with a high cosine similarity tend to share buckets. The top-k
+# mean of each query is taken over the union of its buckets in all tables, which is a
+# lower bound of the exact one. Queries with less than k candidates are computed exactly,
+# so the estimate is never worse than the mean of some k actual similarities.
+# Queries are processed in batches, scoring the union of the candidates of the batch with a
+# single product. When that union covers most of the indexed vectors, the product costs as
+# much as the exact means, which are then taken instead.
+
+LSH_BATCH_SIZE = 1000
+LSH_SAMPLE_SIZE = 1000
+LSH_TOLERANCE = 0.01  # Mean absolute error of the estimates above which CSLS retrieval starts to change
+LSH_EXACT_FRACTION = 0.5  # Fraction of the indexed vectors among the candidates of a batch above which knn_means is exact
+LSH_COMPACT_FRACTION = 0.25  # Fraction of candidates in the scores of a batch below which they are compacted for the top-k
+
+
+class LSHIndex:
+    def __init__(self, m, n_bits, n_tables=1, seed=0):
+        """Hash the rows of m in n_tables tables of n_bits bits each"""
+        if not 0 < n_bits < 63:
+            raise ValueError('The number of bits must be between 1 and 62')
+        rng = np.random.RandomState(seed)
+        self.data = m
+        self.planes = rng.randn(n_tables, m.shape[1], n_bits).astype(m.dtype)
+        self.tables = []
+        for t in range(n_tables):
+            keys = self.hash(m, t)
+            ids = np.argsort(keys, kind='stable')
+            buckets, starts = np.unique(keys[ids], return_index=True)
+            self.tables.append((buckets, np.append(starts, len(ids)), ids))
+
+    def __len__(self):
+        return len(self.data)
+
+    def hash(self, q, table):
+        """Return the bucket of each row of q in the given table"""
+        bits = q.dot(self.planes[table]) > 0
+        return bits.dot(np.int64(1) << np.arange(bits.shape[1], dtype=np.int64))
+
+    def search(self, q, k):
+        """
+        Return the k best similarities and indices for each query in q among the indexed vectors
+        that share a bucket with it in any table (-inf and -1 if there are less than k of them).
+        """
+        n = len(q)
+        scores = np.full((n, k), -np.inf, dtype=q.dtype)
+        ind = np.full((n, k), -1, dtype=np.int64)
+        for i in range(0, n, LSH_BATCH_SIZE):
+            j = min(i + LSH_BATCH_SIZE, n)
+            ranges = self._bucket_ranges(q[i:j])
+            scores[i:j], ind[i:j] = self._search_batch(q[i:j], k, ranges, self._union(ranges))
+        return scores, ind
+
+    def _bucket_ranges(self, q):
+        """Return the range of the sorted ids of each table in the bucket of each row of q (empty if none)"""
+        ranges = []
+        for t, (buckets, starts, ids) in enumerate(self.tables):
+            keys = self.hash(q, t)
+            pos = np.minimum(np.searchsorted(buckets, keys), len(buckets) - 1)
+            hit = buckets[pos] == keys
+            ranges.append((np.where(hit, starts[pos], 0), np.where(hit, starts[pos+1], 0)))
+        return ranges
+
+    def _union(self, ranges):
+        """Return the sorted indices of the vectors in any of the given ranges"""
+        union = np.zeros(len(self.data), dtype=bool)
+        for (_, _, ids), (lo, hi) in zip(self.tables, ranges):
+            hit = hi > lo
+            lo, first = np.unique(lo[hit], return_index=True)  # Each bucket once
+            union[ids[_expand(lo, hi[hit][first])]] = True
+        return np.flatnonzero(union)
+
+    def _search_batch(self, q, k, ranges, union):
+        scores = np.full((len(q), k), -np.inf, dtype=q.dtype)
+        ind = np.full((len(q), k), -1, dtype=np.int64)
+        if len(union) == 0:
+            return scores, ind
+        pos = np.empty(len(self.data), dtype=np.int64)
+        pos[union] = np.arange(len(union))
+        sims = q.dot(self.data[union].T)
+        candidates = np.zeros(sims.shape, dtype=bool)
+        for (_, _, ids), (lo, hi) in zip(self.tables, ranges):
+            candidates[np.repeat(np.arange(len(q)), hi - lo), pos[ids[_expand(lo, hi)]]] = True
+
+        # With few candidates, the -inf scores of the rest would slow down the partition of the top-k selection,
+        # so the candidates of each query are gathered in a row of a compact matrix instead
+        cand_ind = union
+        if np.count_nonzero(candidates) < LSH_COMPACT_FRACTION * candidates.size:
+            rows, cols = np.nonzero(candidates)
+            counts = np.bincount(rows, minlength=len(q))
+            rank = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+            cand_scores = np.full((len(q), counts.max()), -np.inf, dtype=sims.dtype)
+            cand_ind = np.full(cand_scores.shape, -1, dtype=np.int64)
+            cand_scores[rows, rank] = sims[rows, cols]
+            cand_ind[rows, rank] = union[cols]
+            sims = cand_scores
+        else:
+            np.putmask(sims, ~candidates, -np.inf)
+        del candidates
+        top = topk.topk_indices(sims, k)
+        scores[:, :top.shape[1]] = np.take_along_axis(sims, top, axis=1)
+        cand_ind = np.take_along_axis(cand_ind, top, axis=1) if cand_ind.ndim == 2 else cand_ind[top]
+        ind[:, :top.shape[1]] = np.where(np.isinf(scores[:, :top.shape[1]]), -1, cand_ind)
+        return scores, ind
+
+
+def _expand(lo, hi):
+    """Concatenate the ranges [lo, hi)"""
+    lengths = hi - lo
+    return np.repeat(lo - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def knn_means(index, q, k):
+    """Estimate the mean of the k best similarities of each row of q with the indexed vectors"""
+    ans = np.empty(len(q), dtype=q.dtype)
+    for i in range(0, len(q), LSH_BATCH_SIZE):
+        j = min(i + LSH_BATCH_SIZE, len(q))
+        ranges = index._bucket_ranges(q[i:j])
+        union = index._union(ranges)
+        if len(union) >= LSH_EXACT_FRACTION * len(index):
+            ans[i:j] = topk.topk_mean(q[i:j].dot(index.data.T), k, inplace=True)
+            continue
+        scores = index._search_batch(q[i:j], k, ranges, union)[0]
+        ans[i:j] = scores.sum(axis=1) / k
+        exact = np.flatnonzero(np.isinf(scores).any(axis=1))
+        if len(exact) > 0:
+            ans[i+exact] = topk.topk_mean(q[i+exact].dot(index.data.T), k, inplace=True)
+    return ans
+
+
+def error(index, q, k, estimate, sample_size=LSH_SAMPLE_SIZE, seed=0):
+    """Return the mean and maximum absolute error of the estimated knn_means against the exact ones on a sample of q"""
+    sample = np.random.RandomState(seed).choice(len(q), min(sample_size, len(q)), replace=False)
+    exact = topk.topk_mean(q[sample].dot(index.data.T), k, inplace=True)
+    err = np.abs(exact - estimate[sample])
+    return err.mean(), err.max()
@@ -22,34 +22,11 @@ import numpy as np
 import re
 import sys
 import time
+import ann
 import lat_var
-
-
-def dropout(m, p):
-    if p <= 0.0:
-        return m
-    else:
-        xp = get_array_module(m)
-        mask = xp.random.rand(*m.shape) >= p
-        return m*mask
-
-
-def topk_mean(m, k, inplace=False):  # TODO Assuming that axis is 1
-    xp = get_array_module(m)
-    n = m.shape[0]
-    ans = xp.zeros(n, dtype=m.dtype)
-    if k <= 0:
-        return ans
-    if not inplace:
-        m = xp.array(m)
-    ind0 = xp.arange(n)
-    ind1 = xp.empty(n, dtype=int)
-    minimum = m.min()
-    for i in range(k):
-        m.argmax(axis=1, out=ind1)
-        ans += m[ind0, ind1]
-        m[ind0, ind1] = minimum
-    return ans / k
+import lsh
+import retrieval
+import topk
 
 
 def main():
@@ -60,9 +37,12 @@ def main():
     parser.add_argument('src_output', help='the output source embeddings')
     parser.add_argument('trg_output', help='the output target embeddings')
     parser.add_argument('--encoding', default='utf-8', help='the character encoding for input/output (defaults to utf-8)')
+    parser.add_argument('--format', choices=['auto', 'text', 'bin', 'fp16', 'int8', 'int8dim'], default='auto', help='the format of the input embeddings (text: word2vec text; bin: word2vec binary; fp16/int8/int8dim: quantized; defaults to auto, which detects it)')
+    parser.add_argument('--output_format', choices=['text', 'bin', 'fp16', 'int8', 'int8dim'], default='text', help='the format of the output embeddings (fp16: float16 binary; int8: int8 binary with a per-embedding scale; int8dim: int8 binary with a per-dimension scale; defaults to text)')
     parser.add_argument('--precision', choices=['fp16', 'fp32', 'fp64'], default='fp32', help='the floating-point precision (defaults to fp32)')
     parser.add_argument('--cuda', action='store_true', help='use cuda (requires cupy)')
     parser.add_argument('--batch_size', default=10000, type=int, help='batch size (defaults to 10000); does not affect results, larger is usually faster but uses more memory')
+    parser.add_argument('--tile_memory', type=float, default=None, help='the memory budget in MB for the similarity matrix tiles in self-learning, which are then split along both dimensions as needed; it covers the tiles and their temporaries, but not the arrays with a value per word (defaults to batch_size full rows)')
     parser.add_argument('--seed', type=int, default=0, help='the random seed (defaults to 0)')
     parser.add_argument('--test-dict', help='the test dictionary file')
 
@@ -109,11 +89,19 @@ def main():
     self_learning_group.add_argument('--vocabulary_cutoff', type=int, default=0, help='restrict the vocabulary to the top k entries')
     self_learning_group.add_argument('--direction', choices=['forward', 'backward', 'union'], default='union', help='the direction for dictionary induction (defaults to union)')
     self_learning_group.add_argument('--csls', type=int, nargs='?', default=0, const=10, metavar='NEIGHBORHOOD_SIZE', dest='csls_neighborhood', help='use CSLS for dictionary induction')
+    self_learning_group.add_argument('--csls_lsh', type=int, default=0, metavar='BITS', help='estimate the CSLS neighborhood means with sign random projection LSH using hashes of this many bits, reporting their mean absolute error on a sample (defaults to 0, which computes them exactly)')
+    self_learning_group.add_argument('--csls_lsh_tables', type=int, default=16, help='the number of LSH hash tables for --csls_lsh (defaults to 16)')
+    self_learning_group.add_argument('--csls_reuse', type=float, default=0, metavar='TOLERANCE', help='reuse the CSLS neighborhood means of a previous iteration while the mapped embeddings of a sample of words have changed less than this (relative to their norm) since they were computed (defaults to 0, which recomputes them at each iteration)')
+    self_learning_group.add_argument('--csls_refresh', type=int, default=0, metavar='N', help='recompute the CSLS neighborhood means of N words per language in rotation when they are reused (defaults to 0)')
+    self_learning_group.add_argument('--warm_candidates', type=int, default=0, metavar='M', help='keep the M best candidates of each word from the last full dictionary induction, and only score those in the following iterations, with the CSLS neighborhood means of that induction, falling back to a full induction if the objective decreases; the objective is then a lower bound, so the convergence is only tested on full inductions (defaults to 0, which scores all of them at each iteration)')
+    self_learning_group.add_argument('--warm_refresh', type=int, default=10, metavar='N', help='do a full dictionary induction at least every N iterations with --warm_candidates (defaults to 10)')
     self_learning_group.add_argument('--threshold', default=0.000001, type=float, help='the convergence threshold (defaults to 0.000001)')
     self_learning_group.add_argument('--validation', default=None, metavar='DICTIONARY', help='a dictionary file for validation at each iteration')
     self_learning_group.add_argument('--stochastic_initial', default=0.1, type=float, help='initial keep probability stochastic dictionary induction (defaults to 0.1)')
     self_learning_group.add_argument('--stochastic_multiplier', default=2.0, type=float, help='stochastic dictionary induction multiplier (defaults to 2.0)')
     self_learning_group.add_argument('--stochastic_interval', default=50, type=int, help='stochastic dictionary induction interval (defaults to 50)')
+    self_learning_group.add_argument('--ann_lists', type=int, default=0, help='use an approximate nearest neighbor index with this many inverted lists (k-means clusters) for dictionary induction instead of brute force (defaults to 0, which disables it)')
+    self_learning_group.add_argument('--ann_probes', type=int, default=8, help='the number of inverted lists probed per word by the approximate nearest neighbor index (defaults to 8); the recall against brute force is reported on the validation dictionary')
     self_learning_group.add_argument('--log', help='write to a log file in tsv format at each iteration')
     self_learning_group.add_argument('-v', '--verbose', action='store_true', help='write log information to stderr at each iteration')
 
@@ -121,6 +109,9 @@ def main():
     lat_var_group.add_argument('--lat-var', action='store_true', help='use the latent-variable model')
     lat_var_group.add_argument('--n-similar', type=int, default=3, help='# of most similar trg indices used for sparsifying in latent-variable model')
     lat_var_group.add_argument('--n-repeats', default=1, type=int, help='repeats embeddings to get 2:2, 3:3, etc. alignment in latent-variable model')
+    lat_var_group.add_argument('--lap-solver', choices=['lapmod', 'auction'], default='lapmod', help='the assignment solver for the matching in latent-variable model (lapmod: Jonker-Volgenant; auction: approximate parallel auction algorithm, which can leave unmatched a few more words; defaults to lapmod)')
+    lat_var_group.add_argument('--lap-components', action='store_true', help='solve the connected components of the matching graph as independent assignment problems')
+    lat_var_group.add_argument('--lap-workers', type=int, default=None, help='the number of worker processes for --lap-components (defaults to the number of CPUs)')
     lat_var_group.add_argument('--asym', default='1:1', help='specify 1:2 or 2:1 for assymmetric matching in latent-variable model')
     args = parser.parse_args()
 
@@ -158,6 +149,18 @@ def main():
     if (args.src_dewhiten is not None or args.trg_dewhiten is not None) and not args.whiten:
         print('ERROR: De-whitening requires whitening first', file=sys.stderr)
         sys.exit(-1)
+    if args.ann_lists > 0 and args.lat_var:
+        print('ERROR: The approximate nearest neighbor index is not compatible with the latent-variable model', file=sys.stderr)
+        sys.exit(-1)
+    if args.warm_candidates > 0 and (args.lat_var or args.ann_lists > 0):
+        print('ERROR: Warm-started candidates are not compatible with the latent-variable model or the approximate nearest neighbor index', file=sys.stderr)
+        sys.exit(-1)
+    if args.csls_reuse > 0 and args.ann_lists > 0:
+        print('ERROR: Reusing the CSLS neighborhood means is not compatible with the approximate nearest neighbor index', file=sys.stderr)
+        sys.exit(-1)
+    if args.csls_lsh > 0 and args.ann_lists > 0:
+        print('ERROR: The LSH estimate of the CSLS neighborhood means is not compatible with the approximate nearest neighbor index', file=sys.stderr)
+        sys.exit(-1)
 
     if args.verbose:
         print("Info: arguments\n\t" + "\n\t".join(
@@ -175,8 +178,8 @@ def main():
     # Read input embeddings
     srcfile = open(args.src_input, encoding=args.encoding, errors='surrogateescape')
     trgfile = open(args.trg_input, encoding=args.encoding, errors='surrogateescape')
-    src_words, x = embeddings.read(srcfile, dtype=dtype, threshold=200000)
-    trg_words, z = embeddings.read(trgfile, dtype=dtype, threshold=200000)
+    src_words, x = embeddings.read(srcfile, dtype=dtype, threshold=200000, format=args.format)
+    trg_words, z = embeddings.read(trgfile, dtype=dtype, threshold=200000, format=args.format)
 
     # NumPy/CuPy management
     if args.cuda:
@@ -190,10 +193,6 @@ def main():
         xp = np
     xp.random.seed(args.seed)
 
-    # Build word to index map
-    src_word2ind = {word: i for i, word in enumerate(src_words)}
-    trg_word2ind = {word: i for i, word in enumerate(trg_words)}
-
     # STEP 0: Normalization
     embeddings.normalize(x, args.normalize)
     embeddings.normalize(z, args.normalize)
@@ -216,8 +215,8 @@ def main():
         embeddings.normalize(zsim, args.normalize)
         sim = xsim.dot(zsim.T)
         if args.csls_neighborhood > 0:
-            knn_sim_fwd = topk_mean(sim, k=args.csls_neighborhood)
-            knn_sim_bwd = topk_mean(sim.T, k=args.csls_neighborhood)
+            knn_sim_fwd = topk.topk_mean(sim, k=args.csls_neighborhood)
+            knn_sim_bwd = topk.topk_mean(sim.T, k=args.csls_neighborhood)
             sim -= knn_sim_fwd[:, xp.newaxis]/2 + knn_sim_bwd/2
         if args.direction == 'forward':
             src_indices = xp.arange(sim_size)
@@ -233,47 +232,47 @@ def main():
         if args.verbose:
             print('Using numerals as seeds...')
         numeral_regex = re.compile('^[0-9]+$')
-        src_numerals = {word for word in src_words if numeral_regex.match(word) is not None}
-        trg_numerals = {word for word in trg_words if numeral_regex.match(word) is not None}
-        numerals = src_numerals.intersection(trg_numerals)
-        for word in numerals:
-            src_indices.append(src_word2ind[word])
-            trg_indices.append(trg_word2ind[word])
+        src_numerals = list({word for word in src_words if numeral_regex.match(word) is not None})
+        src_ind = src_words.lookup(src_numerals)
+        trg_ind = trg_words.lookup(src_numerals)
+        src_indices = src_ind[trg_ind >= 0].tolist()
+        trg_indices = trg_ind[trg_ind >= 0].tolist()
     elif args.init_identical:
-        identical = set(src_words).intersection(set(trg_words))
+        src_ind = src_words.lookup(src_words)
+        trg_ind = trg_words.lookup(src_words)
+        identical = np.flatnonzero((trg_ind >= 0) & (src_ind == np.arange(len(src_words))))  # Skip repeated words
         if args.verbose:
             print('Using identical strings as seeds...')
             print(f'Found {len(identical)} identical strings.')
-        for word in identical:
-            src_indices.append(src_word2ind[word])
-            trg_indices.append(trg_word2ind[word])
+        src_indices = identical.tolist()
+        trg_indices = trg_ind[identical].tolist()
     else:
         f = open(args.init_dictionary, encoding=args.encoding, errors='surrogateescape')
-        for line in f:
-            src, trg = line.split()
-            try:
-                src_ind = src_word2ind[src]
-                trg_ind = trg_word2ind[trg]
-                src_indices.append(src_ind)
-                trg_indices.append(trg_ind)
-            except KeyError:
+        pairs = [line.split() for line in f]
+        src_ind = src_words.lookup([src for src, trg in pairs]).tolist()
+        trg_ind = trg_words.lookup([trg for src, trg in pairs]).tolist()
+        for (src, trg), src_i, trg_i in zip(pairs, src_ind, trg_ind):
+            if src_i >= 0 and trg_i >= 0:
+                src_indices.append(src_i)
+                trg_indices.append(trg_i)
+            else:
                 print('WARNING: OOV dictionary entry ({0} - {1})'.format(src, trg), file=sys.stderr)
         print(f'Using a dictionary of size {len(src_indices)}.')
 
     # Read validation dictionary
     if args.validation is not None:
         f = open(args.validation, encoding=args.encoding, errors='surrogateescape')
+        pairs = [line.split() for line in f]
+        src_ind = src_words.lookup([src for src, trg in pairs]).tolist()
+        trg_ind = trg_words.lookup([trg for src, trg in pairs]).tolist()
         validation = collections.defaultdict(set)
         oov = set()
         vocab = set()
-        for line in f:
-            src, trg = line.split()
-            try:
-                src_ind = src_word2ind[src]
-                trg_ind = trg_word2ind[trg]
-                validation[src_ind].add(trg_ind)
+        for (src, trg), src_i, trg_i in zip(pairs, src_ind, trg_ind):
+            if src_i >= 0 and trg_i >= 0:
+                validation[src_i].add(trg_i)
                 vocab.add(src)
-            except KeyError:
+            else:
                 oov.add(src)
         oov -= vocab  # If one of the translation options is in the vocabulary, then the entry is not an oov
         validation_coverage = len(validation) / (len(validation) + len(oov))
@@ -287,19 +286,23 @@ def main():
     zw = xp.empty_like(z)
     src_size = x.shape[0] if args.vocabulary_cutoff <= 0 else min(x.shape[0], args.vocabulary_cutoff)
     trg_size = z.shape[0] if args.vocabulary_cutoff <= 0 else min(z.shape[0], args.vocabulary_cutoff)
-    simfwd = xp.empty((args.batch_size, trg_size), dtype=dtype)
-    simbwd = xp.empty((args.batch_size, src_size), dtype=dtype)
     if args.validation is not None:
         simval = xp.empty((len(validation.keys()), z.shape[0]), dtype=dtype)
 
-    best_sim_forward = xp.full(src_size, -100, dtype=dtype)
     src_indices_forward = xp.arange(src_size)
-    trg_indices_forward = xp.zeros(src_size, dtype=int)
-    best_sim_backward = xp.full(trg_size, -100, dtype=dtype)
-    src_indices_backward = xp.zeros(trg_size, dtype=int)
     trg_indices_backward = xp.arange(trg_size)
-    knn_sim_fwd = xp.zeros(src_size, dtype=dtype)
-    knn_sim_bwd = xp.zeros(trg_size, dtype=dtype)
+    knn_sim_fwd = knn_sim_bwd = None
+    src_index = trg_index = None
+    candidates_fwd = candidates_bwd = None
+    last_full_induction = 0
+    csls_reference = None
+    csls_refresh_offset = 0
+    lsh_exact = False  # Whether the LSH estimates were too inaccurate, and the CSLS neighborhood means are computed exactly
+    csls_sample_rng = np.random.RandomState(args.seed)
+    csls_src_sample = xp.asarray(np.sort(csls_sample_rng.choice(src_size, min(src_size, 1000), replace=False)))
+    csls_trg_sample = xp.asarray(np.sort(csls_sample_rng.choice(trg_size, min(trg_size, 1000), replace=False)))
+    tile_memory = None if args.tile_memory is None else int(args.tile_memory * 1024**2)
+    lap_pool = lat_var.worker_pool(args.lap_workers) if args.lat_var and args.lap_components else None  # Kept for all iterations
 
     # Training loop
     best_objective = objective = -100.
@@ -373,47 +376,106 @@ def main():
         if end:
             break
         else:
-            # Update the training dictionary
-            sims = np.zeros((src_size, trg_size), dtype=dtype)
-            if args.direction in ('forward', 'union'):
-                if args.csls_neighborhood > 0:
-                    for i in range(0, trg_size, simbwd.shape[0]):
-                        j = min(i + simbwd.shape[0], trg_size)
-                        zw[i:j].dot(xw[:src_size].T, out=simbwd[:j-i])
-                        knn_sim_bwd[i:j] = topk_mean(simbwd[:j-i], k=args.csls_neighborhood, inplace=True)
-                for i in range(0, src_size, simfwd.shape[0]):
-                    j = min(i + simfwd.shape[0], src_size)
-                    xw[i:j].dot(zw[:trg_size].T, out=simfwd[:j-i])
-                    simfwd[:j-i].max(axis=1, out=best_sim_forward[i:j])
-                    simfwd[:j-i] -= knn_sim_bwd/2  # Equivalent to the real CSLS scores for NN
-                    simfwd[:j-i] = dropout(simfwd[:j-i], 1 - keep_prob)
-                    if not args.lat_var:
-                        # we get a dimension mismatch here as lat_var may produce fewer seeds
-                        simfwd[:j-i].argmax(axis=1, out=trg_indices_forward[i:j])
-                    sims[i:j] = simfwd
-                if args.lat_var:
-                    # TODO check if we can save memory by not storing a large sims matrix
-                    src_indices_forward, trg_indices_forward = lat_var.lat_var(
-                        xp, sims, args.n_similar, args.n_repeats, args.batch_size, args.asym)
-            if args.direction in ('backward', 'union'):
-                if args.csls_neighborhood > 0:
-                    for i in range(0, src_size, simfwd.shape[0]):
-                        j = min(i + simfwd.shape[0], src_size)
-                        xw[i:j].dot(zw[:trg_size].T, out=simfwd[:j-i])
-                        knn_sim_fwd[i:j] = topk_mean(simfwd[:j-i], k=args.csls_neighborhood, inplace=True)
-                for i in range(0, trg_size, simbwd.shape[0]):
-                    j = min(i + simbwd.shape[0], trg_size)
-                    zw[i:j].dot(xw[:src_size].T, out=simbwd[:j-i])
-                    simbwd[:j-i].max(axis=1, out=best_sim_backward[i:j])
-                    simbwd[:j-i] -= knn_sim_fwd/2  # Equivalent to the real CSLS scores for NN
-                    simbwd[:j-i] = dropout(simbwd[:j-i], 1 - keep_prob)
-                    if not args.lat_var:
-                        simbwd[:j-i].argmax(axis=1,out=src_indices_backward[i:j])
-                    sims[i:j] = simbwd
-                if args.lat_var:
+            # Update the training dictionary (xw·zwᵀ is computed once for the CSLS penalties of both
+            # directions, and once more for the nearest neighbors of both directions)
+            forward = args.direction in ('forward', 'union')
+            backward = args.direction in ('backward', 'union')
+            warm = args.warm_candidates > 0 and it - last_full_induction < args.warm_refresh and \
+                it - last_improvement < args.stochastic_interval and \
+                (candidates_fwd is not None or not forward) and (candidates_bwd is not None or not backward)
+            if warm:
+                # Only score the candidates from the last full induction with its CSLS neighborhood means, unless the objective
+                # decreases. The best similarities are then only taken over the candidates, so the objective is a lower bound, and
+                # the convergence is only tested on full inductions (which are forced before the stochastic interval runs out)
+                if forward:
+                    best_sim_forward, trg_indices_forward = retrieval.candidate_neighbors(
+                        xw[:src_size], zw[:trg_size], candidates_fwd, args.batch_size, knn_sim_bwd, keep_prob)
+                if backward:
+                    best_sim_backward, src_indices_backward = retrieval.candidate_neighbors(
+                        zw[:trg_size], xw[:src_size], candidates_bwd, args.batch_size, knn_sim_fwd, keep_prob)
+                warm_objective = (xp.mean(best_sim_forward).tolist() if forward else 0) + (xp.mean(best_sim_backward).tolist() if backward else 0)
+                warm = warm_objective / (2 if forward and backward else 1) >= objective
+            csls_reused = warm  # Warm iterations keep the CSLS neighborhood means of the last iteration
+            if args.csls_neighborhood > 0 and args.csls_reuse > 0 and csls_reference is not None and not warm:
+                # The CSLS neighborhood means can be reused if the embeddings have barely moved since they were computed
+                csls_drift = max([(xp.linalg.norm(m[sample] - ref) / xp.linalg.norm(ref)).tolist() for m, sample, ref in
+                                  ((xw, csls_src_sample, csls_reference[0]), (zw, csls_trg_sample, csls_reference[1]))])
+                csls_reused = csls_drift < args.csls_reuse and (knn_sim_fwd is not None or not backward) and (knn_sim_bwd is not None or not forward)
+            if args.ann_lists > 0:
+                # The indices are rebuilt at each iteration, starting k-means from the previous centroids
+                xw_ann, zw_ann = asnumpy(xw[:src_size]), asnumpy(zw[:trg_size])
+                src_index = ann.IVFIndex(xw_ann, args.ann_lists, seed=args.seed, init=None if src_index is None else src_index.centroids)
+                trg_index = ann.IVFIndex(zw_ann, args.ann_lists, seed=args.seed, init=None if trg_index is None else trg_index.centroids)
+                best_sim_forward, trg_indices_forward, best_sim_backward, src_indices_backward = [
+                    None if a is None else xp.asarray(a) for a in ann.nearest_neighbors(
+                        xw_ann, zw_ann, src_index, trg_index, args.ann_probes, args.csls_neighborhood, keep_prob, forward, backward)]
+            elif csls_reused:
+                if args.csls_refresh > 0:
+                    src_refresh = (csls_refresh_offset + xp.arange(min(args.csls_refresh, src_size))) % src_size
+                    trg_refresh = (csls_refresh_offset + xp.arange(min(args.csls_refresh, trg_size))) % trg_size
+                    csls_refresh_offset += args.csls_refresh
+                    if knn_sim_fwd is not None:
+                        knn_sim_fwd[src_refresh] = retrieval.knn_means(
+                            xw[src_refresh], zw[:trg_size], args.csls_neighborhood, args.batch_size, cols=False, memory=tile_memory)[0]
+                    if knn_sim_bwd is not None:
+                        knn_sim_bwd[trg_refresh] = retrieval.knn_means(
+                            zw[trg_refresh], xw[:src_size], args.csls_neighborhood, args.batch_size, cols=False, memory=tile_memory)[0]
+            elif args.csls_neighborhood > 0 and args.csls_lsh > 0 and not lsh_exact:
+                xw_lsh, zw_lsh = asnumpy(xw[:src_size]), asnumpy(zw[:trg_size])
+                knn_sim_fwd = knn_sim_bwd = None
+                lsh_errors = []
+                if backward:
+                    index = lsh.LSHIndex(zw_lsh, args.csls_lsh, args.csls_lsh_tables, seed=args.seed)
+                    knn_sim_fwd = lsh.knn_means(index, xw_lsh, args.csls_neighborhood)
+                    lsh_errors.append(lsh.error(index, xw_lsh, args.csls_neighborhood, knn_sim_fwd, seed=args.seed))
+                    knn_sim_fwd = xp.asarray(knn_sim_fwd)
+                if forward:
+                    index = lsh.LSHIndex(xw_lsh, args.csls_lsh, args.csls_lsh_tables, seed=args.seed)
+                    knn_sim_bwd = lsh.knn_means(index, zw_lsh, args.csls_neighborhood)
+                    lsh_errors.append(lsh.error(index, zw_lsh, args.csls_neighborhood, knn_sim_bwd, seed=args.seed))
+                    knn_sim_bwd = xp.asarray(knn_sim_bwd)
+                lsh_error = np.mean([e[0] for e in lsh_errors])
+                lsh_max_error = np.max([e[1] for e in lsh_errors])
+                if max([e[0] for e in lsh_errors]) > lsh.LSH_TOLERANCE:
+                    print('WARNING: The LSH error is above {0}, computing the CSLS neighborhood means exactly from now on (use fewer bits or more tables)'.format(lsh.LSH_TOLERANCE), file=sys.stderr)
+                    lsh_exact = True
+                    knn_sim_fwd, knn_sim_bwd = retrieval.knn_means(
+                        xw[:src_size], zw[:trg_size], args.csls_neighborhood, args.batch_size, rows=backward, cols=forward, memory=tile_memory)
+            elif args.csls_neighborhood > 0:
+                knn_sim_fwd, knn_sim_bwd = retrieval.knn_means(
+                    xw[:src_size], zw[:trg_size], args.csls_neighborhood, args.batch_size, rows=backward, cols=forward, memory=tile_memory)
+            if args.csls_neighborhood > 0 and args.csls_reuse > 0 and not csls_reused:
+                csls_reference = (xw[csls_src_sample], zw[csls_trg_sample])
+            if not args.lat_var and args.ann_lists <= 0 and not warm:
+                # The candidates for the warm iterations are collected in the same pass
+                cand_fwd = cand_bwd = None
+                if args.warm_candidates > 0 and forward:
+                    cand_fwd = (xp.empty((src_size, min(args.warm_candidates, trg_size)), dtype=dtype), xp.empty((src_size, min(args.warm_candidates, trg_size)), dtype=int))
+                if args.warm_candidates > 0 and backward:
+                    cand_bwd = (xp.empty((trg_size, min(args.warm_candidates, src_size)), dtype=dtype), xp.empty((trg_size, min(args.warm_candidates, src_size)), dtype=int))
+                best_sim_forward, trg_indices_forward, best_sim_backward, src_indices_backward = retrieval.nearest_neighbors(
+                    xw[:src_size], zw[:trg_size], args.batch_size, knn_sim_fwd, knn_sim_bwd, keep_prob, forward, backward,
+                    cand_fwd=cand_fwd, cand_bwd=cand_bwd, memory=tile_memory)
+                if args.warm_candidates > 0:
+                    last_full_induction = it
+                    candidates_fwd = None if cand_fwd is None else cand_fwd[1]
+                    candidates_bwd = None if cand_bwd is None else cand_bwd[1]
+            if args.lat_var:
+                # Only the n_similar best scores of each word are kept for the matching, so both directions take a single pass
+                top_fwd = (xp.empty((src_size, args.n_similar), dtype=dtype), xp.empty((src_size, args.n_similar), dtype=int)) if forward else None
+                top_bwd = (xp.empty((trg_size, args.n_similar), dtype=dtype), xp.empty((trg_size, args.n_similar), dtype=int)) if backward else None
+                best_sim_forward, _, best_sim_backward, _ = retrieval.nearest_neighbors(
+                    xw[:src_size], zw[:trg_size], args.batch_size, knn_sim_fwd, knn_sim_bwd, keep_prob, forward, backward,
+                    top_fwd=top_fwd, top_bwd=top_bwd, memory=tile_memory)
+                if forward:
+                    src_indices_forward, trg_indices_forward = lat_var.match(
+                        xp, *lat_var.sparse_costs(*top_fwd, args.n_repeats, args.asym), args.n_similar, src_size,
+                        args.lap_solver, args.lap_components, args.lap_workers, lap_pool)
+                if backward:
                     # swap the order of the indices
-                    trg_indices_backward, src_indices_backward = lat_var.lat_var(
-                        xp, sims, args.n_similar, args.n_repeats, args.batch_size, args.asym)
+                    trg_indices_backward, src_indices_backward = lat_var.match(
+                        xp, *lat_var.sparse_costs(*top_bwd, args.n_repeats, args.asym), args.n_similar, trg_size,
+                        args.lap_solver, args.lap_components, args.lap_workers, lap_pool)
             if args.direction == 'forward':
                 src_indices = src_indices_forward
                 trg_indices = trg_indices_forward
@@ -436,7 +498,7 @@ def main():
                 objective = xp.mean(best_sim_backward).tolist()
             elif args.direction == 'union':
                 objective = (xp.mean(best_sim_forward) + xp.mean(best_sim_backward)).tolist() / 2
-            if objective - best_objective >= args.threshold:
+            if objective - best_objective >= args.threshold and not warm:  # The objective is only a lower bound if warm
                 last_improvement = it
                 best_objective = objective
 
@@ -447,6 +509,8 @@ def main():
                 nn = asnumpy(simval.argmax(axis=1))
                 accuracy = np.mean([1 if nn[i] in validation[src[i]] else 0 for i in range(len(src))])
                 similarity = np.mean([max([simval[i, j].tolist() for j in validation[src[i]]]) for i in range(len(src))])
+                if args.ann_lists > 0:
+                    ann_recall = ann.recall(trg_index, asnumpy(xw[src]), args.ann_probes, asnumpy(simval[:, :trg_size].argmax(axis=1)))
 
             # Logging
             duration = time.time() - t
@@ -455,15 +519,34 @@ def main():
                 print('ITERATION {0} ({1:.2f}s)'.format(it, duration), file=sys.stderr)
                 print('\t- Objective:        {0:9.4f}%'.format(100 * objective), file=sys.stderr)
                 print('\t- Drop probability: {0:9.4f}%'.format(100 - 100*keep_prob), file=sys.stderr)
+                if args.warm_candidates > 0:
+                    print('\t- Induction:        {0}'.format('warm (the objective is a lower bound)' if warm else 'full'), file=sys.stderr)
+                if args.csls_neighborhood > 0 and args.csls_reuse > 0:
+                    print('\t- CSLS statistics:  {0}'.format('reused' if csls_reused else 'recomputed'), file=sys.stderr)
+                if args.csls_neighborhood > 0 and args.csls_lsh > 0:
+                    print('\t- CSLS LSH MAE:     {0:9.4f}% (max {1:.4f}%){2}'.format(
+                        100 * lsh_error, 100 * lsh_max_error, ', computed exactly' if lsh_exact else ''), file=sys.stderr)
                 if args.validation is not None:
                     print('\t- Val. similarity:  {0:9.4f}%'.format(100 * similarity), file=sys.stderr)
                     print('\t- Val. accuracy:    {0:9.4f}%'.format(100 * accuracy), file=sys.stderr)
                     print('\t- Val. coverage:    {0:9.4f}%'.format(100 * validation_coverage), file=sys.stderr)
+                    if args.ann_lists > 0:
+                        print('\t- ANN recall:       {0:9.4f}%'.format(100 * ann_recall), file=sys.stderr)
                 sys.stderr.flush()
             if args.log is not None:
                 val = '{0:.6f}\t{1:.6f}\t{2:.6f}'.format(
                     100 * similarity, 100 * accuracy, 100 * validation_coverage) if args.validation is not None else ''
-                print('{0}\t{1:.6f}\t{2}\t{3:.6f}'.format(it, 100 * objective, val, duration), file=log)
+                # Additional fields go after the original ones
+                extra = ''
+                if args.validation is not None and args.ann_lists > 0:
+                    extra += '\t{0:.6f}'.format(100 * ann_recall)
+                if args.warm_candidates > 0:
+                    extra += '\t{0}'.format('warm' if warm else 'full')
+                if args.csls_neighborhood > 0 and args.csls_reuse > 0:
+                    extra += '\t{0}'.format('reused' if csls_reused else 'recomputed')
+                if args.csls_neighborhood > 0 and args.csls_lsh > 0:
+                    extra += '\t{0:.6f}\t{1:.6f}\t{2}'.format(100 * lsh_error, 100 * lsh_max_error, 'exact' if lsh_exact else 'lsh')
+                print('{0}\t{1:.6f}\t{2}\t{3:.6f}{4}'.format(it, 100 * objective, val, duration, extra), file=log)
                 log.flush()
 
         t = time.time()
@@ -473,8 +556,8 @@ def main():
             # save the embeddings for evaluation
             with open(args.src_output, mode='w', encoding=args.encoding, errors='surrogateescape') as srcfile,\
                     open(args.trg_output, mode='w', encoding=args.encoding, errors='surrogateescape') as trgfile:
-                embeddings.write(src_words, xw, srcfile)
-                embeddings.write(trg_words, zw, trgfile)
+                embeddings.write(src_words, xw, srcfile, format=args.output_format)
+                embeddings.write(trg_words, zw, trgfile, format=args.output_format)
 
             # EVALUATING TRANSLATION
             print('Evaluating translation...')
@@ -484,17 +567,17 @@ def main():
             # Read dictionary and compute coverage
             f = open(args.test_dict, encoding=args.encoding,
                      errors='surrogateescape')
+            pairs = [line.split() for line in f]
+            src_ind = src_words.lookup([src for src, trg in pairs]).tolist()
+            trg_ind = trg_words.lookup([trg for src, trg in pairs]).tolist()
             src2trg = collections.defaultdict(set)
             oov = set()
             vocab = set()
-            for line in f:
-                src, trg = line.split()
-                try:
-                    src_ind = src_word2ind[src]
-                    trg_ind = trg_word2ind[trg]
-                    src2trg[src_ind].add(trg_ind)
+            for (src, trg), src_i, trg_i in zip(pairs, src_ind, trg_ind):
+                if src_i >= 0 and trg_i >= 0:
+                    src2trg[src_i].add(trg_i)
                     vocab.add(src)
-                except KeyError:
+                else:
                     oov.add(src)
             src = list(src2trg.keys())
             oov -= vocab  # If one of the translation options is in the vocabulary, then the entry is not an oov
@@ -518,11 +601,14 @@ def main():
                 [1 if translation[i] in src2trg[i] else 0 for i in src])
             print('Coverage:{0:7.2%}  Accuracy:{1:7.2%}'.format(coverage, accuracy))
 
+    if lap_pool is not None:
+        lap_pool.shutdown()
+
     # Write mapped embeddings
     with open(args.src_output, mode='w', encoding=args.encoding, errors='surrogateescape') as srcfile, \
             open(args.trg_output, mode='w', encoding=args.encoding, errors='surrogateescape') as trgfile:
-        embeddings.write(src_words, xw, srcfile)
-        embeddings.write(trg_words, zw, trgfile)
+        embeddings.write(src_words, xw, srcfile, format=args.output_format)
+        embeddings.write(trg_words, zw, trgfile, format=args.output_format)
 
 
 if __name__ == '__main__':
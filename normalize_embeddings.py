@@ -16,7 +16,11 @@
 import embeddings
 
 import argparse
+import concurrent.futures
+import numpy as np
+import os
 import sys
+import tempfile
 
 
 def main():
@@ -26,18 +30,49 @@ def main():
     parser.add_argument('-i', '--input', default=sys.stdin.fileno(), help='the input word embedding file (defaults to stdin)')
     parser.add_argument('-o', '--output', default=sys.stdout.fileno(), help='the output word embedding file (defaults to stdout)')
     parser.add_argument('--encoding', default='utf-8', help='the character encoding for input/output (defaults to utf-8)')
+    parser.add_argument('--format', choices=['auto', 'text', 'bin', 'fp16', 'int8', 'int8dim'], default='auto', help='the format of the input embeddings (text: word2vec text; bin: word2vec binary; fp16/int8/int8dim: quantized; defaults to auto, which detects it)')
+    parser.add_argument('--output_format', choices=['text', 'bin', 'fp16', 'int8', 'int8dim'], default='text', help='the format of the output embeddings (fp16: float16 binary; int8: int8 binary with a per-embedding scale; int8dim: int8 binary with a per-dimension scale; defaults to text)')
     args = parser.parse_args()
 
-    # Read input embeddings
+    # Row-wise actions can be applied one batch at a time in constant memory
     f = open(args.input, encoding=args.encoding, errors='surrogateescape')
-    words, matrix = embeddings.read(f)
+    # (except for int8dim outputs, which need the per-dimension scale of the whole matrix upfront)
+    if all(action in ('unit', 'centeremb') for action in args.actions) and args.output_format != 'int8dim':
+        f = embeddings.decompress(f)
+        fmt = embeddings.detect_format(f) if args.format == 'auto' else args.format
+        header = embeddings.read_header(f, fmt)
+        out = open(args.output, mode='w', encoding=args.encoding, errors='surrogateescape')
+        embeddings.write_header(header[0], header[1], out, args.output_format)
+        # A single process pool formats the text rows of all the batches
+        workers = os.cpu_count() or 1
+        pool = concurrent.futures.ProcessPoolExecutor(workers) if args.output_format == 'text' and workers > 1 else None
+        try:
+            for words, matrix in embeddings.iter_batches(f, format=fmt, header=header):
+                embeddings.normalize(matrix, args.actions)
+                embeddings.write(words, matrix, out, format=args.output_format, header=False, pool=pool)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return
 
-    # Perform normalization actions
-    embeddings.normalize(matrix, args.actions)
+    # Read input embeddings (memory-mapped from the cache if possible)
+    words, matrix = embeddings.read(f, format=args.format)
 
-    # Write normalized embeddings
-    f = open(args.output, mode='w', encoding=args.encoding, errors='surrogateescape')
-    embeddings.write(words, matrix, f)
+    # Perform normalization actions, into a temporary file for memory-mapped embeddings so that
+    # they are processed out of core rather than copied into memory
+    tmp = None
+    if isinstance(matrix, np.memmap):
+        fd, tmp = tempfile.mkstemp(suffix='.npy')
+        os.close(fd)
+    try:
+        matrix = embeddings.normalize(matrix, args.actions, out=tmp)
+
+        # Write normalized embeddings
+        f = open(args.output, mode='w', encoding=args.encoding, errors='surrogateescape')
+        embeddings.write(words, matrix, f, format=args.output_format)
+    finally:
+        if tmp is not None:
+            os.remove(tmp)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+import ann
+import numpy as np
+import scipy.sparse
+import topk
+
+
+# Product quantization for maximum inner product search: the dimensions are split in
+# n_subspaces contiguous subspaces, each of them quantized with its own k-means codebook
+# of (up to) 256 centroids, so each vector is stored as n_subspaces uint8 codes. Queries
+# are scored against the codes with asymmetric distance computation (ADC), i.e. by adding
+# up their dot products with the centroids of each subspace, which are precomputed in a
+# table. The codes are stored as a sparse one-hot matrix, so the table lookups of a whole
+# tile of vectors are done by a single sparse product, which for a few subspaces is faster
+# than the dense product with the vectors themselves. The best candidates are then re-ranked
+# with the exact vectors, which only need to be read for them (so they can be memory-mapped).
+
+PQ_BATCH_SIZE = 1000
+PQ_TILE_SIZE = 10000  # Vectors scored at once for each batch of queries, keeping a running top of the best candidates
+PQ_TRAIN_SIZE = 100000
+
+
+class ProductQuantizer:
+    def __init__(self, m, n_subspaces, n_centroids=256, n_iter=10, seed=0, train_size=PQ_TRAIN_SIZE):
+        """Train the codebooks on (a sample of up to train_size rows of) m"""
+        dim = m.shape[1]
+        if not 0 < n_subspaces <= dim:
+            raise ValueError('The number of subspaces must be between 1 and the dimensionality')
+        if not 0 < n_centroids <= 256:
+            raise ValueError('The number of centroids must be between 1 and 256')
+        rng = np.random.RandomState(seed)
+        sample = np.sort(rng.choice(len(m), min(train_size, len(m)), replace=False))
+        train = np.asarray(m[sample])
+        self.bounds = np.linspace(0, dim, n_subspaces + 1).astype(int)
+        self.codebooks = [ann.kmeans(train[:, a:b], n_centroids, n_iter, seed, spherical=False)[0]
+                          for a, b in zip(self.bounds[:-1], self.bounds[1:])]
+
+    def encode(self, m):
+        """Return the uint8 codes of the rows of m"""
+        codes = np.empty((len(m), len(self.codebooks)), dtype=np.uint8)
+        for i in range(0, len(m), ann.BATCH_SIZE):
+            j = min(i + ann.BATCH_SIZE, len(m))
+            block = np.asarray(m[i:j])
+            for s, (a, b) in enumerate(zip(self.bounds[:-1], self.bounds[1:])):
+                codes[i:j, s] = ann._nearest_centroid(block[:, a:b], self.codebooks[s], spherical=False)
+        return codes
+
+    def decode(self, codes):
+        """Return the reconstruction of the vectors with the given codes"""
+        return np.concatenate([c[codes[:, s]] for s, c in enumerate(self.codebooks)], axis=1)
+
+    def onehot(self, codes, dtype='float32'):
+        """Return the codes as a sparse matrix with a one for the centroid of each vector in each subspace"""
+        offsets = np.cumsum([0] + [len(c) for c in self.codebooks[:-1]])
+        cols = (codes + offsets).ravel()
+        rows = np.repeat(np.arange(len(codes)), codes.shape[1])
+        return scipy.sparse.csr_matrix((np.ones(len(cols), dtype=dtype), (rows, cols)),
+                                       shape=(len(codes), offsets[-1] + len(self.codebooks[-1])))
+
+    def table(self, q):
+        """Return the dot products of q with the centroids of each subspace (a row for each centroid)"""
+        return np.concatenate([c.dot(q[:, a:b].T) for c, a, b in zip(self.codebooks, self.bounds[:-1], self.bounds[1:])])
+
+    def scores(self, q, codes):
+        """Return the ADC estimate of q·mᵀ for the vectors m with the given codes"""
+        return np.asarray(self.onehot(codes, q.dtype).dot(self.table(q)).T)
+
+
+class PQIndex:
+    def __init__(self, m, n_subspaces, n_centroids=256, n_iter=10, seed=0):
+        """Index the rows of m (which are kept, possibly memory-mapped, for the exact re-ranking)"""
+        self.quantizer = ProductQuantizer(m, n_subspaces, n_centroids, n_iter, seed)
+        self.codes = self.quantizer.encode(m)
+        self.onehot = self.quantizer.onehot(self.codes, m.dtype)
+        self.data = m
+
+    def __len__(self):
+        return len(self.codes)
+
+    def search(self, q, k=1, rerank=10, penalty=None):
+        """
+        Return the k best scores and indices for each query in q, where the scores are the
+        similarities minus penalty (given for each indexed vector). The rerank best candidates
+        according to ADC are re-ranked with the exact vectors.
+        """
+        rerank = min(max(rerank, k), len(self.codes))
+        scores = np.empty((len(q), k), dtype=q.dtype)
+        ind = np.empty((len(q), k), dtype=np.int64)
+        for i in range(0, len(q), PQ_BATCH_SIZE):
+            j = min(i + PQ_BATCH_SIZE, len(q))
+            cand = self._candidates(q[i:j], rerank, penalty)
+            rows, inverse = np.unique(cand, return_inverse=True)
+            exact = np.einsum('ij,ikj->ik', q[i:j], np.asarray(self.data[rows])[inverse.reshape(cand.shape)])
+            if penalty is not None:
+                exact -= penalty[cand]
+            best = topk.topk_indices(exact, k, sorted=True)
+            scores[i:j] = np.take_along_axis(exact, best, axis=1)
+            ind[i:j] = np.take_along_axis(cand, best, axis=1)
+        return scores, ind
+
+    def _candidates(self, q, rerank, penalty=None):
+        """Return the indices of the rerank best vectors for each query in q according to ADC"""
+        table = self.quantizer.table(q)
+        tile = min(PQ_TILE_SIZE, len(self.codes))
+        buf = np.empty((len(q), rerank + tile), dtype=q.dtype)  # The best candidates so far followed by the scores of a tile
+        buf[:, :rerank] = -np.inf
+        cand = np.zeros((len(q), rerank), dtype=np.int64)
+        for i in range(0, len(self.codes), tile):
+            j = min(i + tile, len(self.codes))
+            approx = buf[:, :rerank+j-i]
+            approx[:, rerank:] = self.onehot[i:j].dot(table).T
+            if penalty is not None:
+                approx[:, rerank:] -= penalty[i:j]
+            top = topk.topk_indices(approx, rerank)
+            buf[:, :rerank] = np.take_along_axis(approx, top, axis=1)
+            cand = np.where(top < rerank, np.take_along_axis(cand, np.minimum(top, rerank - 1), axis=1), i + top - rerank)
+        return cand
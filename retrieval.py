@@ -0,0 +1,217 @@
+from cupy_utils import *
+
+import topk
+
+
+# Both directions of the self-learning dictionary induction are computed from the same
+# similarity matrix xw·zwᵀ, which is walked one tile at a time: the statistics of the backward
+# direction (zw·xwᵀ) are read from the columns of each tile, so zw·xwᵀ is never computed, and
+# the top-k and argmax results of the tiles in the same row (or column) are merged as they go.
+# CSLS takes two such passes, as the penalized scores of any tile depend on the k nearest
+# neighbors of every target (or source) word, which are only known at the end of the first.
+
+MIN_TILE_ROWS = 256
+
+
+def tile_shape(n, m, itemsize, batch_size, memory=None, buffers=2):
+    """
+    Choose the shape of the tiles of an n x m similarity matrix, with at most batch_size rows,
+    so that the given number of tile buffers fits in memory bytes (full rows if memory is None).
+    The buffers count every array of the size of a tile with the given itemsize that can be alive
+    at once, including temporaries, so it can be fractional for those of other types.
+    """
+    rows = max(min(batch_size, n), 1)
+    if memory is None:
+        return rows, m
+    cells = max(int(int(memory) // (buffers*itemsize)), 1)
+    if rows*m <= cells:
+        return rows, m
+    if cells // m >= MIN_TILE_ROWS:
+        return min(rows, cells // m), m
+    rows = max(min(rows, int(cells**0.5)), 1)
+    return rows, max(min(m, cells // rows), 1)
+
+
+def _tiles(n, m, shape):
+    for i in range(0, n, shape[0]):
+        for j in range(0, m, shape[1]):
+            yield i, min(i + shape[0], n), j, min(j + shape[1], m)
+
+
+def dropout(m, p):
+    if p <= 0.0:
+        return m
+    else:
+        xp = get_array_module(m)
+        mask = xp.random.rand(*m.shape) >= p
+        return m*mask
+
+
+def knn_means(xw, zw, k, batch_size, rows=True, cols=True, memory=None):
+    """
+    Return the mean similarity of each row of xw to its k nearest neighbors in zw (if rows)
+    and of each row of zw to its k nearest neighbors in xw (if cols), or None otherwise
+    """
+    xp = get_array_module(xw)
+    n, m = xw.shape[0], zw.shape[0]
+    if k <= 0:
+        return xp.zeros(n, dtype=xw.dtype) if rows else None, xp.zeros(m, dtype=xw.dtype) if cols else None
+    # The tile, the copy partitioned for the columns in the first row of tiles and the boolean mask of _merge_column_topk
+    shape = tile_shape(n, m, xw.dtype.itemsize, batch_size, memory, buffers=2 + 1/xw.dtype.itemsize)
+    buf = xp.empty(shape[0]*shape[1], dtype=xw.dtype)
+    row_top = xp.empty((shape[0], 2*k), dtype=xw.dtype)
+    col_top = xp.full((min(k, n), m), -xp.inf, dtype=xw.dtype)
+    knn_fwd = xp.empty(n, dtype=xw.dtype) if rows else None
+    for i0, i1, j0, j1 in _tiles(n, m, shape):
+        sim = buf[:(i1-i0)*(j1-j0)].reshape(i1-i0, j1-j0)
+        xw[i0:i1].dot(zw[j0:j1].T, out=sim)
+        if cols and i0 == 0 and i1 >= k:
+            col_top[:, j0:j1] = xp.partition(sim, i1-k, axis=0)[i1-k:]
+        elif cols:
+            _merge_column_topk(xp, col_top[:, j0:j1], sim, k)
+        if rows:
+            top = topk.topk_values(sim, k, inplace=True)
+            if j0 == 0:
+                row_top[:i1-i0, :k] = -xp.inf
+            row_top[:i1-i0, k:k+top.shape[1]] = top
+            row_top[:i1-i0, k+top.shape[1]:] = -xp.inf
+            row_top[:i1-i0].partition(k, axis=1)
+            if j1 == m:
+                knn_fwd[i0:i1] = xp.where(xp.isinf(row_top[:i1-i0, k:]), 0, row_top[:i1-i0, k:]).sum(axis=1) / k
+            else:
+                row_top[:i1-i0, :k] = row_top[:i1-i0, k:]
+    knn_bwd = xp.where(xp.isinf(col_top), 0, col_top).sum(axis=0) / k if cols else None
+    return knn_fwd, knn_bwd
+
+
+def _merge_column_topk(xp, top, block, k):
+    """Update the k largest values of each column (top, unordered, updated in place) with a new block of rows"""
+    m = block.shape[1]
+    ind = xp.flatnonzero(block > top.min(axis=0))  # Only these can enter the top k
+    if len(ind) == 0:
+        return
+    i, j = ind // m, ind % m
+    vals = block[i, j]
+    order = xp.lexsort(xp.stack((-vals, j)))
+    j, vals = j[order], vals[order]
+    cols, starts = xp.unique(j, return_index=True)
+    group = xp.searchsorted(cols, j)
+    rank = xp.arange(len(j)) - starts[group]
+    keep = rank < len(top)
+    merged = xp.full((len(cols), 2*len(top)), -xp.inf, dtype=top.dtype)
+    merged[:, :len(top)] = top[:, cols].T
+    merged[group[keep], len(top) + rank[keep]] = vals[keep]
+    merged.partition(len(top), axis=1)
+    top[:, cols] = merged[:, len(top):].T
+
+
+def nearest_neighbors(xw, zw, batch_size, knn_fwd=None, knn_bwd=None, keep_prob=1.0, forward=True, backward=True,
+                      out_fwd=None, out_bwd=None, top_fwd=None, top_bwd=None, cand_fwd=None, cand_bwd=None, memory=None):
+    """
+    In a single pass over xw·zwᵀ, compute the best similarity of each row of xw and its nearest
+    neighbor in zw according to the scores penalized by knn_bwd/2 (the equivalent of CSLS for
+    nearest neighbor retrieval) after dropout, and the same for each row of zw if backward.
+    The penalized scores can be stored in out_fwd (like xw·zwᵀ) and out_bwd (like zw·xwᵀ), or
+    only the k best of each row in top_fwd and top_bwd, given as a pair of (rows, k) arrays for
+    their values and indices (unordered). cand_fwd and cand_bwd are filled in the same way with
+    the best penalized scores before dropout (the candidates of candidate_neighbors).
+    Return best_fwd, nn_fwd, best_bwd, nn_bwd (None for the directions that are not computed).
+    """
+    xp = get_array_module(xw)
+    n, m = xw.shape[0], zw.shape[0]
+    best_fwd = nn_fwd = best_bwd = nn_bwd = None
+    if forward:
+        best_fwd = xp.full(n, -xp.inf, dtype=xw.dtype)
+        nn_fwd = xp.zeros(n, dtype=int)
+        score_fwd = xp.full(n, -xp.inf, dtype=xw.dtype)
+    if backward:
+        best_bwd = xp.full(m, -xp.inf, dtype=xw.dtype)
+        nn_bwd = xp.zeros(m, dtype=int)
+        score_bwd = xp.full(m, -xp.inf, dtype=xw.dtype)
+    # The tile and the scores, plus the copy made by argmax along the columns, the float64 random numbers, mask and
+    # product of dropout, and the int64 indices partitioned for the top-k buffers
+    itemsize = xw.dtype.itemsize
+    buffers = 2 + (1 if backward else 0)
+    if keep_prob < 1.0:
+        buffers += 1 + 9/itemsize
+    if top_fwd is not None or top_bwd is not None or cand_fwd is not None or cand_bwd is not None:
+        buffers += 8/itemsize
+    shape = tile_shape(n, m, itemsize, batch_size, memory, buffers)
+    buf = xp.empty(shape[0]*shape[1], dtype=xw.dtype)
+    csls_buf = xp.empty_like(buf)
+    for i0, i1, j0, j1 in _tiles(n, m, shape):
+        sim = buf[:(i1-i0)*(j1-j0)].reshape(i1-i0, j1-j0)
+        csls = csls_buf[:(i1-i0)*(j1-j0)].reshape(i1-i0, j1-j0)
+        xw[i0:i1].dot(zw[j0:j1].T, out=sim)
+        if forward:
+            xp.maximum(best_fwd[i0:i1], sim.max(axis=1), out=best_fwd[i0:i1])
+            if knn_bwd is not None:
+                xp.subtract(sim, knn_bwd[j0:j1]/2, out=csls)
+            else:
+                csls[...] = sim
+            scores = dropout(csls, 1 - keep_prob)
+            _update_max(score_fwd[i0:i1], nn_fwd[i0:i1], scores, 1, j0)
+            if out_fwd is not None:
+                out_fwd[i0:i1, j0:j1] = scores
+            if top_fwd is not None:
+                _merge_topk(top_fwd[0][i0:i1], top_fwd[1][i0:i1], scores, j0, j0 == 0)
+            if cand_fwd is not None:
+                _merge_topk(cand_fwd[0][i0:i1], cand_fwd[1][i0:i1], csls, j0, j0 == 0)
+        if backward:
+            xp.maximum(best_bwd[j0:j1], sim.max(axis=0), out=best_bwd[j0:j1])
+            if knn_fwd is not None:
+                xp.subtract(sim, knn_fwd[i0:i1, xp.newaxis]/2, out=csls)
+            else:
+                csls[...] = sim
+            scores = dropout(csls, 1 - keep_prob)
+            _update_max(score_bwd[j0:j1], nn_bwd[j0:j1], scores, 0, i0)
+            if out_bwd is not None:
+                out_bwd[j0:j1, i0:i1] = scores.T
+            if top_bwd is not None:
+                _merge_topk(top_bwd[0][j0:j1], top_bwd[1][j0:j1], scores.T, i0, i0 == 0)
+            if cand_bwd is not None:
+                _merge_topk(cand_bwd[0][j0:j1], cand_bwd[1][j0:j1], csls.T, i0, i0 == 0)
+    return best_fwd, nn_fwd, best_bwd, nn_bwd
+
+
+def _update_max(best, arg, scores, axis, offset):
+    """Merge the maximum (and its position) along the given axis of a tile into best and arg"""
+    tile_max = scores.max(axis=axis)
+    better = tile_max > best  # Strict, so that ties go to the first tile as in argmax
+    best[better] = tile_max[better]
+    arg[better] = scores.argmax(axis=axis)[better] + offset
+
+
+def _merge_topk(values, indices, scores, offset, reset):
+    """Merge the k best scores (and their column indices) of each row of a tile into values and indices"""
+    xp = get_array_module(scores)
+    k = values.shape[1]
+    if reset:
+        values[...] = -xp.inf
+        indices[...] = -1
+    top = topk.topk_indices(scores, k)
+    cand_values = xp.concatenate((values, xp.take_along_axis(scores, top, axis=1)), axis=1)
+    cand_indices = xp.concatenate((indices, top + offset), axis=1)
+    best = topk.topk_indices(cand_values, k)
+    values[...] = xp.take_along_axis(cand_values, best, axis=1)
+    indices[...] = xp.take_along_axis(cand_indices, best, axis=1)
+
+
+def candidate_neighbors(xw, zw, candidates, batch_size, penalty=None, keep_prob=1.0):
+    """
+    Same as the forward direction of nearest_neighbors, but only scoring the given candidates of each
+    row of xw in zw (as collected in cand_fwd). Return the best similarity and nearest neighbor.
+    """
+    xp = get_array_module(xw)
+    best = xp.empty(xw.shape[0], dtype=xw.dtype)
+    nn = xp.empty(xw.shape[0], dtype=int)
+    for i in range(0, xw.shape[0], batch_size):
+        j = min(i + batch_size, xw.shape[0])
+        cand = candidates[i:j]
+        sim = xp.einsum('ij,ikj->ik', xw[i:j], zw[cand])
+        best[i:j] = sim.max(axis=1)
+        if penalty is not None:
+            sim -= penalty[cand]/2
+        scores = dropout(sim, 1 - keep_prob)
+        nn[i:j] = xp.take_along_axis(cand, scores.argmax(axis=1)[:, xp.newaxis], axis=1)[:, 0]
+    return best, nn
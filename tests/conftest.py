@@ -0,0 +1,15 @@
+import numpy as np
+import os
+import pytest
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+@pytest.fixture
+def unit_vectors():
+    """A function that returns n random unit vectors of the given dimensionality as the rows of a matrix"""
+    def make(n, dim=20, seed=0):
+        m = np.random.RandomState(seed).randn(n, dim)
+        return m / np.linalg.norm(m, axis=1)[:, np.newaxis]
+    return make
@@ -0,0 +1,41 @@
+import ann
+import numpy as np
+import pytest
+import retrieval
+
+
+def test_kmeans(unit_vectors):
+    m = unit_vectors(300)
+    centroids, assignment = ann.kmeans(m, 8)
+    assert centroids.shape == (8, 20) and np.allclose(np.linalg.norm(centroids, axis=1), 1)
+    assert np.array_equal(assignment, m.dot(centroids.T).argmax(axis=1))
+
+
+def test_search_all_lists(unit_vectors):
+    # Probing every list gives the exact results
+    x, q = unit_vectors(300), unit_vectors(100, seed=1)
+    index = ann.IVFIndex(x, 8)
+    penalty = np.random.RandomState(2).rand(300) / 10
+    scores, ind, best = index.search(q, 8, 5, penalty)
+    exact = q.dot(x.T) - penalty
+    assert np.array_equal(np.sort(ind, axis=1), np.sort(np.argsort(-exact, axis=1)[:, :5], axis=1))
+    assert np.allclose(scores, np.take_along_axis(exact, ind, axis=1))
+    assert np.allclose(best, q.dot(x.T).max(axis=1))
+
+
+@pytest.mark.parametrize('k', [0, 10])
+def test_nearest_neighbors_all_lists(k, unit_vectors):
+    xw, zw = unit_vectors(300), unit_vectors(200, seed=1)
+    src_index, trg_index = ann.IVFIndex(xw, 8), ann.IVFIndex(zw, 8)
+    knn_fwd, knn_bwd = retrieval.knn_means(xw, zw, k, 100)
+    expected = retrieval.nearest_neighbors(xw, zw, 100, knn_fwd if k > 0 else None, knn_bwd if k > 0 else None)
+    for a, b in zip(ann.nearest_neighbors(xw, zw, src_index, trg_index, 8, k), expected):
+        assert np.allclose(a, b)
+
+
+def test_recall(unit_vectors):
+    xw, zw = unit_vectors(300), unit_vectors(200, seed=1)
+    index = ann.IVFIndex(zw, 8)
+    nn = xw.dot(zw.T).argmax(axis=1)
+    assert ann.recall(index, xw, 8, nn) == 1.0
+    assert 0 < ann.recall(index, xw, 1, nn) <= 1.0
@@ -0,0 +1,41 @@
+import auction
+import numpy as np
+import pytest
+from scipy.optimize import linear_sum_assignment
+
+
+def sparse_problem(n, density, seed):
+    """A random cost matrix and a mask of the entries each row can take"""
+    rng = np.random.RandomState(seed)
+    costs = rng.rand(n, n)
+    mask = rng.rand(n, n) < density
+    return costs, mask
+
+
+def sparse(costs, mask):
+    rows, cols = np.nonzero(mask)
+    return costs[rows, cols], cols, np.concatenate(([0], np.cumsum(mask.sum(axis=1))))
+
+
+@pytest.mark.parametrize('n', [50, 300])
+def test_auction_perfect_matching(n):
+    # A sparse problem with a perfect matching, on which the auction is optimal within n*eps_min
+    costs, mask = sparse_problem(n, 0.1, n)
+    mask[np.arange(n), np.random.RandomState(n).permutation(n)] = True
+    cc, kk, ii = sparse(costs, mask)
+    cost, x = auction.solve(cc, kk, ii, patience=10**6)
+    assert (x >= 0).all() and len(set(x.tolist())) == n
+    dense = np.where(mask, costs, np.inf)
+    r, c = linear_sum_assignment(dense)
+    assert cost == pytest.approx(dense[r, c].sum(), abs=n*1e-6)
+
+
+def test_auction_infeasible():
+    # Without a perfect matching, some rows are given up, and the rest are a valid assignment
+    costs, mask = sparse_problem(300, 0.005, 0)
+    cc, kk, ii = sparse(costs, mask)
+    cost, x = auction.solve(cc, kk, ii)
+    assigned = np.flatnonzero(x >= 0)
+    assert len(assigned) < 300 and len(set(x[assigned].tolist())) == len(assigned)
+    assert mask[assigned, x[assigned]].all()
+    assert cost == pytest.approx(costs[assigned, x[assigned]].sum())
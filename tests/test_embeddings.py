@@ -0,0 +1,212 @@
+import embeddings
+import numpy as np
+import pytest
+
+
+WORDS = ['w{0}'.format(i) for i in range(47)] + ['ñandú', 'über', 'x']
+
+
+def random_matrix(n, dim=5, seed=0):
+    return np.random.RandomState(seed).randn(n, dim).astype(np.float32)
+
+
+def write(path, words, matrix, **kwargs):
+    with open(path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+        embeddings.write(words, matrix, f, **kwargs)
+
+
+def write_text(path, n, dim=5, seed=0):
+    words, matrix = ['w{0}'.format(i) for i in range(n)], random_matrix(n, dim, seed)
+    write(path, words, matrix)
+    return words, matrix
+
+
+def read(path, **kwargs):
+    kwargs.setdefault('dtype', 'float32')
+    with open(path, encoding='utf-8', errors='surrogateescape') as f:
+        return embeddings.read(f, **kwargs)
+
+
+def expected(matrix, format):
+    """The values that a read gives back for each format"""
+    if format in embeddings.QUANTIZATIONS:
+        return embeddings.quantize(matrix, format).dequantize('float32')
+    if format == 'text':
+        return np.array(['%.6g' % v for v in matrix.ravel()], dtype=np.float32).reshape(matrix.shape)
+    return matrix
+
+
+def cached_rows(path):
+    with open(path + '.vocab', 'rb') as f:
+        f.readline()
+        return f.read().count(b'\n')
+
+
+@pytest.mark.parametrize('format', embeddings.FORMATS)
+@pytest.mark.parametrize('extension', ['', '.gz', '.bz2', '.xz'])
+@pytest.mark.parametrize('cache', [False, True])
+def test_round_trip(tmp_path, format, extension, cache):
+    path = str(tmp_path / ('emb' + extension))
+    matrix = random_matrix(len(WORDS))
+    write(path, WORDS, matrix, format=format)
+    for _ in range(2):  # Cold and warm cache
+        words, m = read(path, cache=cache)
+        assert isinstance(words, embeddings.Vocabulary)
+        assert list(words) == WORDS
+        assert np.array_equal(m, expected(matrix, format))
+    words, m = read(path, threshold=10, cache=cache)
+    assert list(words) == WORDS[:10] and np.array_equal(m, expected(matrix, format)[:10])
+
+
+@pytest.mark.parametrize('format', embeddings.QUANTIZATIONS)
+def test_quantized_round_trip(tmp_path, format):
+    path = str(tmp_path / 'emb')
+    quantized = embeddings.quantize(random_matrix(len(WORDS)), format)
+    write(path, WORDS, quantized, format=format)
+    words, m = read(path, dequantize=False)
+    assert isinstance(m, embeddings.Quantized) and m.quantization == format
+    assert np.array_equal(m.codes, quantized.codes)
+    assert np.array_equal(m.dequantize('float32'), quantized.dequantize('float32'))
+
+
+@pytest.mark.parametrize('format', ['text', 'bin'])
+def test_parallel_read(tmp_path, monkeypatch, format):
+    path = str(tmp_path / 'emb')
+    matrix = random_matrix(len(WORDS))
+    write(path, WORDS, matrix, format=format)
+    monkeypatch.setattr(embeddings, 'PARALLEL_MIN_BYTES', 0)
+    for cache in (False, True):
+        words, m = read(path, cache=cache, workers=2)
+        assert list(words) == WORDS and np.array_equal(m, expected(matrix, format))
+    words, m = read(path, cache=False, workers=2, vocabulary={'w3', 'über', 'missing'})
+    assert list(words) == ['w3', 'über'] and np.array_equal(m, expected(matrix, format)[[3, 48]])
+
+
+@pytest.mark.parametrize('format', ['text', 'bin'])
+def test_indexed_read(tmp_path, format):
+    path = str(tmp_path / 'emb')
+    matrix = random_matrix(len(WORDS))
+    write(path, WORDS, matrix, format=format)
+    vocabulary = {'w40', 'ñandú', 'w2', 'missing'}
+    for _ in range(2):  # Building and loading the index
+        words, m = read(path, vocabulary=vocabulary)
+        assert list(words) == ['w2', 'w40', 'ñandú']
+        assert np.array_equal(m, expected(matrix, format)[[2, 40, 47]])
+    assert (tmp_path / 'emb.index.npz').exists()
+    words, m = read(path, vocabulary=vocabulary, threshold=10)
+    assert list(words) == ['w2']
+
+
+def test_cache_invalidation(tmp_path):
+    path = str(tmp_path / 'emb.txt')
+    write_text(path, 20)
+    read(path)
+    words, matrix = write_text(path, 30, seed=1)
+    w, m = read(path)
+    assert list(w) == words and np.array_equal(m, expected(matrix, 'text'))
+
+
+def test_cache_threshold(tmp_path):
+    path = str(tmp_path / 'emb.txt')
+    words, matrix = write_text(path, 50)
+    w, m = read(path, threshold=20)
+    assert list(w) == words[:20] and np.allclose(m, matrix[:20], atol=1e-6)
+    assert cached_rows(path) == 20 and np.load(path + '.float32.npy').shape == (20, 5)
+
+    # A smaller threshold is served from the cache, and a larger one parses the file again
+    w, m = read(path, threshold=10)
+    assert isinstance(m, np.memmap) and list(w) == words[:10]
+    w, m = read(path)
+    assert list(w) == words and np.allclose(m, matrix, atol=1e-6)
+    assert cached_rows(path) == 50
+    w, m = read(path, threshold=30)
+    assert isinstance(m, np.memmap) and list(w) == words[:30]
+
+
+def test_cache_threshold_above_count(tmp_path):
+    path = str(tmp_path / 'emb.txt')
+    words, matrix = write_text(path, 10)
+    read(path, threshold=20)
+    w, m = read(path)
+    assert isinstance(m, np.memmap) and list(w) == words
+
+
+@pytest.mark.parametrize('format', embeddings.FORMATS)
+@pytest.mark.parametrize('extension', ['', '.gz'])
+def test_iter_batches(tmp_path, format, extension):
+    path = str(tmp_path / ('emb' + extension))
+    matrix = random_matrix(len(WORDS))
+    write(path, WORDS, matrix, format=format)
+    with open(path, encoding='utf-8', errors='surrogateescape') as f:
+        batches = list(embeddings.iter_batches(f, batch_size=7, dtype='float32'))
+    assert all(len(words) == len(m) <= 7 for words, m in batches)
+    assert [w for words, _ in batches for w in words] == WORDS
+    assert np.array_equal(np.concatenate([m for _, m in batches]), expected(matrix, format))
+
+
+def test_write_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(embeddings, 'WRITE_BATCH_SIZE', 8)
+    matrix = random_matrix(len(WORDS))
+    write(str(tmp_path / 'a'), WORDS, matrix, workers=1)
+    write(str(tmp_path / 'b'), WORDS, matrix, workers=2)
+    data = (tmp_path / 'a').read_bytes()
+    assert data == (tmp_path / 'b').read_bytes()
+    assert data.splitlines()[1] == ('w0 ' + ' '.join(['%.6g' % v for v in matrix[0]])).encode('utf-8')
+
+
+def test_vocabulary():
+    vocabulary = embeddings.Vocabulary(WORDS + ['w1'])
+    assert len(vocabulary) == len(WORDS) + 1 and vocabulary[47] == 'ñandú' and vocabulary[-1] == 'w1'
+    assert list(vocabulary[45:48]) == WORDS[45:48]
+    assert list(vocabulary[[48, 0]]) == ['über', 'w0']
+    assert vocabulary.lookup(['w1', 'über', 'missing']).tolist() == [len(WORDS), 48, -1]  # Last occurrence
+    assert 'x' in vocabulary and 'y' not in vocabulary
+
+
+# The normalization actions as they were implemented before they were fused into blocked passes
+
+def baseline_normalize(matrix, actions):
+    for action in actions:
+        if action == 'unit':
+            norms = np.sqrt(np.sum(matrix**2, axis=1))
+            norms[norms == 0] = 1
+            matrix /= norms[:, np.newaxis]
+        elif action == 'center':
+            matrix -= np.mean(matrix, axis=0)
+        elif action == 'unitdim':
+            norms = np.sqrt(np.sum(matrix**2, axis=0))
+            norms[norms == 0] = 1
+            matrix /= norms
+        elif action == 'centeremb':
+            matrix -= np.mean(matrix, axis=1)[:, np.newaxis]
+
+
+ACTIONS = [['unit'], ['center'], ['unitdim'], ['centeremb'], ['unit', 'center', 'unit'], ['center', 'unitdim'],
+           ['unitdim', 'center', 'unit', 'centeremb', 'unitdim'], ['center', 'center', 'unitdim', 'unitdim']]
+
+
+@pytest.mark.parametrize('actions', ACTIONS)
+@pytest.mark.parametrize('mean', [0, 1000])
+def test_normalize(monkeypatch, actions, mean):
+    monkeypatch.setattr(embeddings, 'NORMALIZE_BATCH_SIZE', 64)
+    matrix = random_matrix(1500, 40) + np.float32(mean)
+    exact, baseline = matrix.astype(np.float64), matrix.copy()
+    baseline_normalize(exact, actions)
+    baseline_normalize(baseline, actions)
+    embeddings.normalize(matrix, actions)
+    assert np.abs(matrix - exact).max() <= 2*np.abs(baseline - exact).max() + 1e-6  # As accurate as the baseline
+    if actions[-1] == 'unitdim':
+        assert np.allclose(np.linalg.norm(matrix, axis=0), 1, atol=1e-5)
+
+
+def test_normalize_out_of_core(tmp_path, monkeypatch):
+    monkeypatch.setattr(embeddings, 'NORMALIZE_BATCH_SIZE', 64)
+    actions = ['unit', 'center', 'unit']
+    np.save(str(tmp_path / 'in.npy'), random_matrix(500, 20))
+    matrix = np.load(str(tmp_path / 'in.npy'), mmap_mode='r')
+    reference = np.array(matrix, dtype=np.float64)
+    baseline_normalize(reference, actions)
+    out = embeddings.normalize(matrix, actions, out=str(tmp_path / 'out.npy'))
+    assert isinstance(out, np.memmap) and np.allclose(out, reference, atol=1e-6)
+    assert np.allclose(np.load(str(tmp_path / 'out.npy')), reference, atol=1e-6)
+    assert np.array_equal(matrix, np.load(str(tmp_path / 'in.npy')))  # The input is left untouched
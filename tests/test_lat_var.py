@@ -0,0 +1,90 @@
+import lat_var
+import numpy as np
+import pytest
+from scipy.optimize import linear_sum_assignment
+
+
+def random_problem(n, n_repeats, asym='1:1', n_similar=3, seed=0):
+    rng = np.random.RandomState(seed)
+    x = rng.randn(n, 20)
+    x /= np.linalg.norm(x, axis=1)[:, np.newaxis]
+    z = x + 0.5*rng.randn(n, 20)
+    z /= np.linalg.norm(z, axis=1)[:, np.newaxis]
+    values, indices = lat_var.sparse_candidates(np, x.dot(z.T), n_similar, 100)
+    return lat_var.sparse_costs(values, indices, n_repeats, asym)
+
+
+def reference_match(cc, kk, ii, n_similar, src_size):
+    """Match with linear_sum_assignment on the dense costs, where leaving a row unmatched costs more than any candidate"""
+    n, m = len(ii) - 1, kk.max() + 1
+    costs = np.full((n, m + n), np.inf)
+    costs[np.repeat(np.arange(n), np.diff(ii)), kk] = cc
+    costs[:, m:] = cc.max() + 1
+    rows, cols = linear_sum_assignment(costs)
+    x = np.where(cols < m, cols, -1)[np.argsort(rows)]
+    return lat_var.assignment_pairs(x, kk, n_similar, src_size)
+
+
+def pair_set(src, trg):
+    return sorted(zip(src.tolist(), trg.tolist()))
+
+
+def pair_cost(cc, kk, ii, src, trg, src_size):
+    return sum(cc[ii[s] + list(kk[ii[s]:ii[s+1]] % src_size).index(t)] for s, t in zip(src, trg))
+
+
+@pytest.mark.parametrize('solver', ['lapmod', 'auction'])
+def test_solve_rectangular(solver):
+    # Two rows and three columns, where the optimum (with cost 1.0) uses the first column
+    cc = np.array([0.5, 0.9, 0.5, 0.9])
+    kk = np.array([0, 1, 1, 2])
+    ii = np.array([0, 2, 4])
+    assert lat_var._solve(cc, kk, ii, 3, solver, lat_var._unmatched_cost(cc)).tolist() == [0, 1]
+    assert lat_var._solve_components(cc, kk, ii, solver, workers=1).tolist() == [0, 1]
+
+
+@pytest.mark.parametrize('n_repeats,asym', [(1, '1:1'), (2, '1:1'), (2, '1:2')])
+def test_match_lapmod_optimal(n_repeats, asym):
+    n = 300
+    cc, kk, ii = random_problem(n, n_repeats, asym)
+    expected = reference_match(cc, kk, ii, 3, n)
+    for components in (False, True):
+        src, trg = lat_var.match(np, cc, kk, ii, 3, n, 'lapmod', components, workers=1)
+        assert len(src) == len(expected[0])
+        assert pair_cost(cc, kk, ii, src, trg, n) == pytest.approx(pair_cost(cc, kk, ii, *expected, n))
+        if n_repeats == 1:
+            assert pair_set(src, trg) == pair_set(*expected)
+
+
+@pytest.mark.parametrize('solver', ['lapmod', 'auction'])
+@pytest.mark.parametrize('n_repeats', [1, 2])
+def test_match_components(solver, n_repeats):
+    n = 500
+    cc, kk, ii = random_problem(n, n_repeats, seed=1)
+    expected = pair_set(*lat_var.match(np, cc, kk, ii, 3, n, solver))
+    assert pair_set(*lat_var.match(np, cc, kk, ii, 3, n, solver, True, workers=1)) == expected
+    assert pair_set(*lat_var.match(np, cc, kk, ii, 3, n, solver, True, workers=2)) == expected
+    with lat_var.worker_pool(2) as pool:  # The same pool for several calls
+        for _ in range(2):
+            assert pair_set(*lat_var.match(np, cc, kk, ii, 3, n, solver, True, workers=2, pool=pool)) == expected
+
+
+def test_solve_task_single_thread(monkeypatch):
+    # Auction uses a single thread in each task, as the tasks already run in a pool of processes
+    calls = []
+    solve = lat_var.auction.solve
+    monkeypatch.setattr(lat_var.auction, 'solve', lambda *args, **kwargs: calls.append(kwargs['workers']) or solve(*args, **kwargs))
+    cc, kk, ii = random_problem(100, 1)
+    lat_var._solve_task([(cc, kk, ii, kk.max() + 1)], 'auction', lat_var._unmatched_cost(cc))
+    assert calls == [1]
+
+
+def test_match_auction_valid():
+    n = 500
+    cc, kk, ii = random_problem(n, 1, seed=2)
+    src, trg = lat_var.match(np, cc, kk, ii, 3, n, 'auction')
+    assert len(set(src.tolist())) == len(src) and len(set(trg.tolist())) == len(trg)
+    candidates = kk.reshape(n, 3)
+    assert (candidates[src] == trg[:, np.newaxis]).any(axis=1).all()
+    expected = reference_match(cc, kk, ii, 3, n)
+    assert len(src) >= 0.99 * len(expected[0])
@@ -0,0 +1,67 @@
+import lsh
+import numpy as np
+import pytest
+import topk
+
+
+def test_search(unit_vectors):
+    x, q = unit_vectors(500), unit_vectors(100, seed=1)
+    index = lsh.LSHIndex(x, 4, 2)
+    scores, ind = index.search(q, 5)
+    rows, cols = np.nonzero(ind >= 0)
+    assert np.allclose(scores[rows, cols], np.einsum('ij,ij->i', q[rows], x[ind[rows, cols]]))
+    shared = [index.hash(q[rows], t) == index.hash(x[ind[rows, cols]], t) for t in range(2)]
+    assert (shared[0] | shared[1]).all()
+
+
+@pytest.mark.parametrize('n_bits,n_tables', [(1, 1), (4, 4), (8, 2)])
+def test_knn_means(n_bits, n_tables, unit_vectors):
+    x, q = unit_vectors(500), unit_vectors(100, seed=1)
+    exact = topk.topk_mean(q.dot(x.T), 10)
+    index = lsh.LSHIndex(x, n_bits, n_tables)
+    estimate = lsh.knn_means(index, q, 10)
+    assert (estimate <= exact + 1e-9).all()
+    mean_error, max_error = lsh.error(index, q, 10, estimate)
+    assert mean_error == pytest.approx(np.abs(exact - estimate).mean())
+    assert max_error == pytest.approx(np.abs(exact - estimate).max())
+
+
+def test_knn_means_tables(unit_vectors):
+    # The first tables are the same for any number of tables, so more tables can only reduce the error
+    x, q = unit_vectors(500), unit_vectors(100, seed=1)
+    errors = [lsh.error(lsh.LSHIndex(x, 4, n_tables), q, 10, lsh.knn_means(lsh.LSHIndex(x, 4, n_tables), q, 10))[0]
+              for n_tables in (1, 4, 16)]
+    assert errors[0] >= errors[1] >= errors[2]
+    assert errors[2] < lsh.LSH_TOLERANCE
+
+
+@pytest.mark.parametrize('compact_fraction', [0, 1])
+def test_search_brute_force(compact_fraction, unit_vectors, monkeypatch):
+    # Both ways of selecting the top-k among the candidates give the best similarities among the vectors sharing a bucket
+    monkeypatch.setattr(lsh, 'LSH_COMPACT_FRACTION', compact_fraction)
+    x, q = unit_vectors(500), unit_vectors(100, seed=1)
+    index = lsh.LSHIndex(x, 6, 3)
+    scores, ind = index.search(q, 5)
+    order = np.argsort(-scores, axis=1)
+    scores, ind = np.take_along_axis(scores, order, axis=1), np.take_along_axis(ind, order, axis=1)
+    shared = np.zeros((len(q), len(x)), dtype=bool)
+    for t in range(3):
+        shared |= index.hash(q, t)[:, None] == index.hash(x, t)[None, :]
+    sims = np.where(shared, q.dot(x.T), -np.inf)
+    expected = -np.sort(-sims, axis=1)[:, :5]
+    assert np.array_equal(np.isinf(scores), np.isinf(expected))
+    assert np.allclose(scores[~np.isinf(scores)], expected[~np.isinf(expected)])
+    assert (ind[np.isinf(scores)] == -1).all()
+
+
+@pytest.mark.parametrize('exact_fraction', [0, 2])
+def test_knn_means_exact(exact_fraction, unit_vectors, monkeypatch):
+    # Batches whose candidates cover enough of the indexed vectors are computed exactly
+    monkeypatch.setattr(lsh, 'LSH_EXACT_FRACTION', exact_fraction)
+    x, q = unit_vectors(500), unit_vectors(100, seed=1)
+    exact = topk.topk_mean(q.dot(x.T), 10)
+    estimate = lsh.knn_means(lsh.LSHIndex(x, 6, 2), q, 10)
+    if exact_fraction == 0:
+        assert np.allclose(estimate, exact)
+    else:
+        assert (estimate <= exact + 1e-6).all() and not np.allclose(estimate, exact)
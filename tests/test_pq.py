@@ -0,0 +1,43 @@
+import numpy as np
+import pq
+import pytest
+
+
+def test_scores(unit_vectors):
+    # ADC scores are the similarities to the decoded vectors
+    m, q = unit_vectors(500), unit_vectors(50, seed=1)
+    quantizer = pq.ProductQuantizer(m, 4, 16)
+    codes = quantizer.encode(m)
+    assert codes.dtype == np.uint8 and codes.shape == (500, 4) and codes.max() < 16
+    assert np.allclose(quantizer.scores(q, codes), q.dot(quantizer.decode(codes).T))
+
+
+def test_search_rerank_all(unit_vectors):
+    # Re-ranking every vector gives the exact results
+    m, q = unit_vectors(500), unit_vectors(50, seed=1)
+    index = pq.PQIndex(m, 4, 16)
+    penalty = np.random.RandomState(2).rand(500) / 10
+    scores, ind = index.search(q, 3, rerank=500, penalty=penalty)
+    exact = q.dot(m.T) - penalty
+    assert np.array_equal(ind, np.argsort(-exact, axis=1)[:, :3])
+    assert np.allclose(scores, np.take_along_axis(exact, ind, axis=1))
+
+
+def test_search(unit_vectors):
+    m, q = unit_vectors(500), unit_vectors(50, seed=1)
+    scores, ind = pq.PQIndex(m, 4, 16).search(q, 2, rerank=10)
+    assert np.allclose(scores, np.einsum('ij,ikj->ik', q, m[ind]))
+    assert (scores[:, 0] >= scores[:, 1]).all()
+
+
+@pytest.mark.parametrize('tile_size', [7, 100, 1000])
+def test_candidates_tiles(tile_size, unit_vectors, monkeypatch):
+    # Merging the best candidates of each tile gives the best ADC scores over all the vectors
+    monkeypatch.setattr(pq, 'PQ_TILE_SIZE', tile_size)
+    m, q = unit_vectors(500), unit_vectors(50, seed=1)
+    index = pq.PQIndex(m, 4, 16)
+    penalty = np.random.RandomState(2).rand(500) / 10
+    approx = index.quantizer.scores(q, index.codes) - penalty
+    cand = index._candidates(q, 10, penalty)
+    assert all(len(set(row)) == 10 for row in cand.tolist())
+    assert np.allclose(np.sort(np.take_along_axis(approx, cand, axis=1), axis=1), np.sort(approx, axis=1)[:, -10:])
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+import retrieval
+import tracemalloc
+
+
+# Memory budgets (in bytes) for full rows, row tiles and tiles split along both dimensions
+MEMORY = [None, 200*300*8*3, 50*70*8*3]
+
+
+def dense_knn_means(sims, k):
+    return -np.sort(-sims, axis=1)[:, :k].mean(axis=1)
+
+
+@pytest.mark.parametrize('shape', [(200, 300), (300, 200)])
+@pytest.mark.parametrize('memory', MEMORY)
+@pytest.mark.parametrize('buffers', [2, 3.25])
+def test_tile_shape(shape, memory, buffers):
+    rows, cols = retrieval.tile_shape(*shape, 8, 100, memory, buffers)
+    assert 1 <= rows <= 100 and 1 <= cols <= shape[1]
+    if memory is not None:
+        assert rows*cols*8*buffers <= memory
+
+
+@pytest.mark.parametrize('memory', MEMORY)
+@pytest.mark.parametrize('k', [1, 10])
+def test_knn_means(memory, k, unit_vectors):
+    xw, zw = unit_vectors(200), unit_vectors(300, seed=1)
+    sims = xw.dot(zw.T)
+    knn_fwd, knn_bwd = retrieval.knn_means(xw, zw, k, 64, memory=memory)
+    assert np.allclose(knn_fwd, dense_knn_means(sims, k))
+    assert np.allclose(knn_bwd, dense_knn_means(sims.T, k))
+    assert retrieval.knn_means(xw, zw, k, 64, rows=False, memory=memory)[0] is None
+
+
+@pytest.mark.parametrize('memory', MEMORY)
+@pytest.mark.parametrize('csls', [False, True])
+def test_nearest_neighbors(memory, csls, unit_vectors):
+    xw, zw = unit_vectors(200), unit_vectors(300, seed=1)
+    sims = xw.dot(zw.T)
+    knn_fwd, knn_bwd = (dense_knn_means(sims, 10), dense_knn_means(sims.T, 10)) if csls else (None, None)
+    scores_fwd = sims - knn_bwd/2 if csls else sims
+    scores_bwd = sims.T - knn_fwd/2 if csls else sims.T
+    out_fwd, out_bwd = np.empty_like(sims), np.empty_like(sims.T)
+    top_fwd = (np.empty((200, 3)), np.empty((200, 3), dtype=int))
+    top_bwd = (np.empty((300, 3)), np.empty((300, 3), dtype=int))
+    best_fwd, nn_fwd, best_bwd, nn_bwd = retrieval.nearest_neighbors(
+        xw, zw, 64, knn_fwd, knn_bwd, out_fwd=out_fwd, out_bwd=out_bwd, top_fwd=top_fwd, top_bwd=top_bwd, memory=memory)
+    assert np.allclose(best_fwd, sims.max(axis=1)) and np.allclose(best_bwd, sims.max(axis=0))
+    assert np.array_equal(nn_fwd, scores_fwd.argmax(axis=1)) and np.array_equal(nn_bwd, scores_bwd.argmax(axis=1))
+    assert np.allclose(out_fwd, scores_fwd) and np.allclose(out_bwd, scores_bwd)
+    for (values, indices), scores in ((top_fwd, scores_fwd), (top_bwd, scores_bwd)):
+        assert np.array_equal(np.sort(indices, axis=1), np.sort(np.argsort(-scores, axis=1)[:, :3], axis=1))
+        assert np.allclose(values, np.take_along_axis(scores, indices, axis=1))
+
+
+def test_nearest_neighbors_directions(unit_vectors):
+    xw, zw = unit_vectors(200), unit_vectors(300, seed=1)
+    best_fwd, nn_fwd, best_bwd, nn_bwd = retrieval.nearest_neighbors(xw, zw, 64, backward=False)
+    assert best_bwd is None and nn_bwd is None
+    assert np.array_equal(nn_fwd, xw.dot(zw.T).argmax(axis=1))
+
+
+@pytest.mark.parametrize('memory', [None, 64*1024])
+@pytest.mark.parametrize('csls', [False, True])
+def test_candidate_neighbors(memory, csls, unit_vectors):
+    # The candidates are collected in a full induction, and they are the best scores regardless of dropout
+    xw, zw = unit_vectors(200), unit_vectors(300, seed=1)
+    sims = xw.dot(zw.T)
+    knn_fwd, knn_bwd = (dense_knn_means(sims, 10), dense_knn_means(sims.T, 10)) if csls else (None, None)
+    cand_fwd = (np.empty((200, 20)), np.empty((200, 20), dtype=int))
+    cand_bwd = (np.empty((300, 20)), np.empty((300, 20), dtype=int))
+    retrieval.nearest_neighbors(xw, zw, 64, knn_fwd, knn_bwd, keep_prob=0.5, cand_fwd=cand_fwd, cand_bwd=cand_bwd, memory=memory)
+    scores, scores_bwd = (sims - knn_bwd/2, sims.T - knn_fwd/2) if csls else (sims, sims.T)
+    candidates = cand_fwd[1]
+    assert np.array_equal(np.sort(candidates, axis=1), np.sort(np.argsort(-scores, axis=1)[:, :20], axis=1))
+    assert np.array_equal(np.sort(cand_bwd[1], axis=1), np.sort(np.argsort(-scores_bwd, axis=1)[:, :20], axis=1))
+    best, nn = retrieval.candidate_neighbors(xw, zw, candidates, 64, knn_bwd)
+    assert np.array_equal(nn, scores.argmax(axis=1))
+    assert np.allclose(best, np.take_along_axis(sims, candidates, axis=1).max(axis=1))
+
+
+@pytest.mark.parametrize('keep_prob', [1.0, 0.9])
+@pytest.mark.parametrize('top', [None, 'top', 'cand'])
+def test_tile_memory(keep_prob, top, unit_vectors):
+    # The peak memory is within the budget, except for the arrays with a value per word
+    xw, zw = unit_vectors(2000), unit_vectors(2000, seed=1)
+    xw, zw = xw.astype(np.float32), zw.astype(np.float32)
+    knn_fwd, knn_bwd = retrieval.knn_means(xw, zw, 10, 500)
+    memory, per_word = 2*1024**2, 2000*8*16
+    buffers = {top: ((np.empty((2000, 3), dtype=np.float32), np.empty((2000, 3), dtype=int)),
+                     (np.empty((2000, 3), dtype=np.float32), np.empty((2000, 3), dtype=int)))}
+    top_fwd, top_bwd = buffers.get('top', (None, None))
+    cand_fwd, cand_bwd = buffers.get('cand', (None, None))
+    tracemalloc.start()
+    try:
+        retrieval.knn_means(xw, zw, 10, 500, memory=memory)
+        retrieval.nearest_neighbors(xw, zw, 500, knn_fwd, knn_bwd, keep_prob=keep_prob, top_fwd=top_fwd, top_bwd=top_bwd,
+                                    cand_fwd=cand_fwd, cand_bwd=cand_bwd, memory=memory)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak <= memory + per_word
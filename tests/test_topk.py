@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+import topk
+
+
+@pytest.fixture
+def m():
+    return np.random.RandomState(0).randn(600, 300).astype(np.float32)
+
+
+@pytest.mark.parametrize('k', [0, 1, 10, 300, 400])
+def test_topk_values(m, k):
+    expected = -np.sort(-m, axis=1)[:, :k]
+    assert np.array_equal(np.sort(topk.topk_values(m, k), axis=1)[:, ::-1], expected)
+    assert np.array_equal(np.sort(topk.topk_values(m.copy(), k, inplace=True), axis=1)[:, ::-1], expected)
+
+
+@pytest.mark.parametrize('k', [1, 10, 300])
+def test_topk_indices(m, k):
+    expected = np.argsort(-m, axis=1, kind='stable')[:, :k]
+    assert np.array_equal(topk.topk_indices(m, k, sorted=True), expected)
+    assert np.array_equal(np.sort(topk.topk_indices(m, k), axis=1), np.sort(expected, axis=1))
+
+
+@pytest.mark.parametrize('k', [0, 10])
+def test_topk_mean(m, k):
+    expected = -np.sort(-m, axis=1)[:, :k].sum(axis=1) / max(k, 1)
+    original = m.copy()
+    assert np.allclose(topk.topk_mean(m, k), expected, atol=1e-5)
+    assert np.array_equal(m, original)
@@ -0,0 +1,55 @@
+from cupy_utils import *
+
+
+# The k largest entries of each row are selected with a single partition (introselect)
+# rather than k argmax sweeps. Rows are processed in blocks, so that a copy is only made
+# for one block at a time when the input must be preserved. All functions work along axis 1.
+
+TOPK_BATCH_SIZE = 256
+
+
+def topk_values(m, k, inplace=False):
+    """Return the k largest values in each row of m (in no particular order)"""
+    xp = get_array_module(m)
+    n, cols = m.shape
+    k = min(k, cols)
+    ans = xp.empty((n, max(k, 0)), dtype=m.dtype)
+    if k <= 0:
+        return ans
+    buf = None if inplace else xp.empty((min(TOPK_BATCH_SIZE, n), cols), dtype=m.dtype)
+    for i in range(0, n, TOPK_BATCH_SIZE):
+        j = min(i + TOPK_BATCH_SIZE, n)
+        if inplace:
+            block = m[i:j]
+        else:
+            block = buf[:j-i]
+            block[...] = m[i:j]
+        block.partition(cols - k, axis=1)
+        ans[i:j] = block[:, cols-k:]
+    return ans
+
+
+def topk_indices(m, k, sorted=False):
+    """Return the column indices of the k largest values in each row of m (in decreasing order if sorted)"""
+    xp = get_array_module(m)
+    n, cols = m.shape
+    k = min(k, cols)
+    ans = xp.empty((n, max(k, 0)), dtype=xp.int64)
+    if k <= 0:
+        return ans
+    for i in range(0, n, TOPK_BATCH_SIZE):
+        j = min(i + TOPK_BATCH_SIZE, n)
+        ind = xp.argpartition(m[i:j], cols - k, axis=1)[:, cols-k:]
+        if sorted:
+            order = xp.argsort(-xp.take_along_axis(m[i:j], ind, axis=1), axis=1)
+            ind = xp.take_along_axis(ind, order, axis=1)
+        ans[i:j] = ind
+    return ans
+
+
+def topk_mean(m, k, inplace=False):
+    """Return the mean of the k largest values in each row of m"""
+    xp = get_array_module(m)
+    if k <= 0:
+        return xp.zeros(m.shape[0], dtype=m.dtype)
+    return topk_values(m, k, inplace=inplace).sum(axis=1) / k